@@ -0,0 +1,230 @@
+import asyncio
+import json
+import logging
+import threading
+import zlib
+from contextlib import contextmanager
+from datetime import timedelta
+from typing import Dict, Iterable, List, Optional
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, IntegerField, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import metrics
+from .encoding import dumps
+from .models import ArchivedSegment, Message, Room, RoomMembership, User
+from .search import get_backend as search_backend
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_AFTER_DAYS = getattr(settings, "CHAT_ARCHIVE_AFTER_DAYS", 90)
+SEGMENT_SIZE = getattr(settings, "CHAT_ARCHIVE_SEGMENT_SIZE", 1000)
+# 0 disables the in-process job; run `manage.py archive_messages` instead.
+ARCHIVE_INTERVAL_SECONDS = getattr(settings, "CHAT_ARCHIVE_INTERVAL_SECONDS", 0)
+
+# Cold tier layout: each room's oldest messages are cut into segments of
+# SEGMENT_SIZE rows, [id, user_id, username, text, created_at], kept in
+# (created_at, id) order and zlib-compressed. Archiving always takes the
+# oldest hot rows, so every cold message of a room sorts before every hot
+# one and a history page only ever has to continue from hot into cold.
+
+_state = threading.local()
+
+
+@contextmanager
+def archiving():
+    """
+    Message deletes inside are archive moves, not removals: the
+    message_activity observer and the per-row post_delete receivers skip
+    them, and archive_segment un-indexes and invalidates once per batch.
+    """
+    previous = getattr(_state, "archiving", False)
+    _state.archiving = True
+    try:
+        yield
+    finally:
+        _state.archiving = previous
+
+
+def is_archiving() -> bool:
+    return getattr(_state, "archiving", False)
+
+
+def _encode_rows(messages: Iterable[Message]) -> bytes:
+    rows = [[m.pk, m.user_id, m.user.username, m.text, m.created_at.isoformat()] for m in messages]
+    return zlib.compress(dumps(rows).encode())
+
+
+def _decode_rows(segment: ArchivedSegment) -> List[list]:
+    return json.loads(zlib.decompress(bytes(segment.data)))
+
+
+def _hydrate(room_id: int, rows: List[list]) -> List[Message]:
+    """Unsaved Message instances for archived rows, with .user attached."""
+    users = User.objects.in_bulk({row[1] for row in rows})
+    messages = []
+    for pk, user_id, username, text, created_at in rows:
+        msg = Message(pk=pk, room_id=room_id, user_id=user_id, text=text, created_at=parse_datetime(created_at))
+        msg.user = users.get(user_id) or User(pk=user_id, username=username)
+        messages.append(msg)
+    return messages
+
+
+def archive_segment(room_id: int, cutoff, segment_size: int = SEGMENT_SIZE) -> int:
+    """
+    Move the oldest `segment_size` messages of a room created before
+    `cutoff` into one segment, in one transaction. Room.last_message always
+    stays hot. Returns the number of messages archived.
+    """
+    from . import backlog  # backlog -> history -> archive
+
+    with transaction.atomic():
+        keep = Room.objects.filter(pk=room_id).values_list("last_message_id", flat=True).first()
+        batch = list(Message.objects.filter(room_id=room_id, created_at__lt=cutoff)
+                     .exclude(pk=keep).select_related("user")
+                     .order_by("created_at", "id")[:segment_size])
+        if not batch:
+            return 0
+        last_seq = ArchivedSegment.objects.filter(room_id=room_id).aggregate(Max("seq"))["seq__max"]
+        ids = [m.pk for m in batch]
+        ArchivedSegment.objects.create(
+            room_id=room_id,
+            seq=(last_seq or 0) + 1,
+            first_id=min(ids),
+            last_id=max(ids),
+            first_created_at=batch[0].created_at,
+            last_created_at=batch[-1].created_at,
+            count=len(batch),
+            data=_encode_rows(batch),
+        )
+        # Message.delete() takes unread messages off each reader's count;
+        # the queryset delete below does not, so do it for the whole batch.
+        unread = (Message.objects.filter(pk__in=ids, created_at__gt=OuterRef("last_seen"))
+                  .exclude(user_id=OuterRef("user_id")).order_by()
+                  .values("room_id").annotate(n=Count("pk")).values("n"))
+        RoomMembership.objects.filter(room_id=room_id, unread_count__gt=0).update(
+            unread_count=Greatest(
+                F("unread_count") - Coalesce(Subquery(unread, output_field=IntegerField()), 0),
+                Value(0),
+            )
+        )
+        with archiving():
+            Message.objects.filter(pk__in=ids).delete()
+        transaction.on_commit(lambda: search_backend().remove_messages(ids))
+        transaction.on_commit(lambda: backlog.invalidate(room_id))
+    return len(batch)
+
+
+def archive_room(room_id: int, cutoff, segment_size: int = SEGMENT_SIZE) -> int:
+    """Archive every message of a room created before `cutoff`, one segment per transaction."""
+    total = 0
+    while True:
+        count = archive_segment(room_id, cutoff, segment_size)
+        total += count
+        if count < segment_size:
+            return total
+
+
+def rooms_to_archive(cutoff) -> List[int]:
+    return list(Message.objects.filter(created_at__lt=cutoff)
+                .order_by().values_list("room_id", flat=True).distinct())
+
+
+@metrics.instrument("chat_archive_seconds", op="archive_old_messages")
+def archive_old_messages(older_than_days: float = ARCHIVE_AFTER_DAYS, segment_size: int = SEGMENT_SIZE,
+                         room_ids: Optional[Iterable[int]] = None) -> Dict[int, int]:
+    """Archive every room's messages older than the given age; returns {room_id: archived}."""
+    cutoff = timezone.now() - timedelta(days=older_than_days)
+    if room_ids is None:
+        room_ids = rooms_to_archive(cutoff)
+    archived = {}
+    for room_id in room_ids:
+        count = archive_room(room_id, cutoff, segment_size)
+        if count:
+            archived[room_id] = count
+    return archived
+
+
+def _locate(segments, message_id: int):
+    """((segment, rows), index) of an archived message, or None."""
+    for segment in segments.filter(first_id__lte=message_id, last_id__gte=message_id):
+        rows = _decode_rows(segment)
+        for index, row in enumerate(rows):
+            if row[0] == message_id:
+                return (segment, rows), index
+    return None
+
+
+def cold_messages_before(room_id: int, before_id: Optional[int] = None, limit: int = 50) -> List[Message]:
+    """
+    Archived messages of a room older than `before_id` (or the newest
+    archived ones when it is None), oldest first. Returns [] when
+    `before_id` is not an archived message of the room.
+    """
+    segments = ArchivedSegment.objects.filter(room_id=room_id).order_by("-seq")
+    picked: List[list] = []
+    if before_id is None:
+        segment = segments.first()
+    else:
+        anchor = _locate(segments, before_id)
+        if anchor is None:
+            return []
+        anchor_segment, index = anchor
+        picked = anchor_segment[1][:index][::-1][:limit]
+        segment = segments.filter(seq__lt=anchor_segment[0].seq).first() if len(picked) < limit else None
+
+    while segment is not None and len(picked) < limit:
+        picked.extend(_decode_rows(segment)[::-1][:limit - len(picked)])
+        if len(picked) < limit:
+            segment = segments.filter(seq__lt=segment.seq).first()
+    picked.reverse()
+    return _hydrate(room_id, picked)
+
+
+class Archiver:
+    """
+    In-process background job that runs archive_old_messages every
+    `interval` seconds. Started by the first ChatConsumer connection when
+    CHAT_ARCHIVE_INTERVAL_SECONDS is set.
+    """
+    def __init__(self, interval: float = ARCHIVE_INTERVAL_SECONDS):
+        self.interval = interval
+        self._task = None
+
+    def ensure_started(self) -> None:
+        if self.interval and (self._task is None or self._task.done()):
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                archived = await self.archive_pass()
+            except Exception:
+                logger.exception("Message archival failed")
+                continue
+            if archived:
+                logger.info("Archived %d messages from %d rooms", sum(archived.values()), len(archived))
+
+    async def archive_pass(self) -> Dict[int, int]:
+        # One writer-lane hop per segment rather than per pass, so message
+        # and read-position writes queue behind one segment at most.
+        cutoff = timezone.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+        room_ids = await metrics.db_hop(rooms_to_archive, "rooms_to_archive")(cutoff)
+        segment = metrics.db_hop(archive_segment, "archive_segment", write=True)
+        archived = {}
+        for room_id in room_ids:
+            while True:
+                count = await segment(room_id, cutoff, SEGMENT_SIZE)
+                if count:
+                    archived[room_id] = archived.get(room_id, 0) + count
+                if count < SEGMENT_SIZE:
+                    break
+        return archived
+
+
+archiver = Archiver()
@@ -0,0 +1,145 @@
+from collections import defaultdict
+from typing import Dict, Iterable, List, Set
+
+from django.conf import settings
+
+from .models import RoomMembership
+from .redis_client import redis_client
+
+AUDIENCE_TTL = getattr(settings, "PRESENCE_AUDIENCE_TTL_SECONDS", 300)
+WATCH_MAX = getattr(settings, "PRESENCE_WATCH_MAX", 500)
+WATCH_TTL = getattr(settings, "PRESENCE_WATCH_TTL_SECONDS", 24 * 60 * 60)
+
+# Who cares about whose presence, as Redis sets of user ids:
+#   presence:user:{id}:peers     users sharing a room with id (cached from
+#                                RoomMembership; 0 marks "no peers")
+#   presence:user:{id}:watching  users id asked to follow explicitly
+#   presence:user:{id}:watchers  the reverse of watching
+# audience(X) = peers ∪ watchers: who is told about X's transitions.
+# interest(X) = peers ∪ watching: whose state X gets on connect.
+
+_NO_PEERS = 0
+
+def _peers_key(user_id: int) -> str:
+    return f"presence:user:{user_id}:peers"
+
+def _watching_key(user_id: int) -> str:
+    return f"presence:user:{user_id}:watching"
+
+def _watchers_key(user_id: int) -> str:
+    return f"presence:user:{user_id}:watchers"
+
+
+def _ids(raw: Iterable) -> Set[int]:
+    return {int(uid) for uid in raw if int(uid) != _NO_PEERS}
+
+
+def load_peers(user_ids: Iterable[int]) -> Dict[int, Set[int]]:
+    """Users sharing at least one room with each of `user_ids`, in one query."""
+    user_ids = list(user_ids)
+    peers: Dict[int, Set[int]] = {uid: set() for uid in user_ids}
+    rows = (RoomMembership.objects.filter(room__memberships__user_id__in=user_ids)
+            .values_list("room__memberships__user_id", "user_id").distinct())
+    for user_id, peer_id in rows:
+        if peer_id != user_id:
+            peers[user_id].add(peer_id)
+    return peers
+
+
+def _ensure_peers(client, user_ids: List[int]) -> None:
+    pipe = client.pipeline(transaction=False)
+    for uid in user_ids:
+        pipe.exists(_peers_key(uid))
+    missing = [uid for uid, found in zip(user_ids, pipe.execute()) if not found]
+    if not missing:
+        return
+    pipe = client.pipeline(transaction=False)
+    for uid, peers in load_peers(missing).items():
+        pipe.sadd(_peers_key(uid), *(peers or [_NO_PEERS]))
+        pipe.expire(_peers_key(uid), AUDIENCE_TTL)
+    pipe.execute()
+
+
+def audiences(user_ids: Iterable[int]) -> Dict[int, Set[int]]:
+    """{user_id: users to tell about its presence}, one DB query at most."""
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return {}
+    client = redis_client()
+    _ensure_peers(client, user_ids)
+    pipe = client.pipeline(transaction=False)
+    for uid in user_ids:
+        pipe.sunion(_peers_key(uid), _watchers_key(uid))
+    return {uid: _ids(raw) for uid, raw in zip(user_ids, pipe.execute())}
+
+
+def interest(user_id: int) -> Set[int]:
+    """Users whose presence `user_id` follows."""
+    client = redis_client()
+    _ensure_peers(client, [user_id])
+    return _ids(client.sunion(_peers_key(user_id), _watching_key(user_id)))
+
+
+def watch(user_id: int, user_ids: Iterable[int]) -> None:
+    """Follow users outside any shared room; the list is capped at WATCH_MAX."""
+    client = redis_client()
+    room = WATCH_MAX - client.scard(_watching_key(user_id))
+    user_ids = [uid for uid in dict.fromkeys(int(uid) for uid in user_ids) if uid not in (user_id, _NO_PEERS)]
+    user_ids = user_ids[:max(room, 0)]
+    if not user_ids:
+        return
+    pipe = client.pipeline(transaction=False)
+    pipe.sadd(_watching_key(user_id), *user_ids)
+    pipe.expire(_watching_key(user_id), WATCH_TTL)
+    for uid in user_ids:
+        pipe.sadd(_watchers_key(uid), user_id)
+        pipe.expire(_watchers_key(uid), WATCH_TTL)
+    pipe.execute()
+
+
+def unwatch(user_id: int, user_ids: Iterable[int]) -> None:
+    user_ids = list({int(uid) for uid in user_ids})
+    if not user_ids:
+        return
+    pipe = redis_client().pipeline(transaction=False)
+    pipe.srem(_watching_key(user_id), *user_ids)
+    for uid in user_ids:
+        pipe.srem(_watchers_key(uid), user_id)
+    pipe.execute()
+
+
+# New memberships are added to the cached peer sets in place (only where
+# a set is cached, so a missing one is still rebuilt in full); removals
+# just drop the affected sets. A change racing a rebuild is corrected by
+# AUDIENCE_TTL at the latest.
+
+_ADD_IF_CACHED = """
+for i = 1, #KEYS do
+  if redis.call('EXISTS', KEYS[i]) == 1 then
+    redis.call('SADD', KEYS[i], ARGV[i])
+    redis.call('SREM', KEYS[i], 0)
+  end
+end
+"""
+
+def memberships_added(pairs: Iterable[tuple]) -> None:
+    """Record new (room_id, user_id) memberships in the cached peer sets."""
+    by_room = defaultdict(set)
+    for room_id, user_id in pairs:
+        by_room[room_id].add(user_id)
+    if not by_room:
+        return
+    keys, args = [], []
+    rows = RoomMembership.objects.filter(room_id__in=by_room).values_list("room_id", "user_id")
+    for room_id, member_id in rows:
+        for user_id in by_room[room_id]:
+            if member_id != user_id:
+                keys += [_peers_key(member_id), _peers_key(user_id)]
+                args += [user_id, member_id]
+    if keys:
+        redis_client().register_script(_ADD_IF_CACHED)(keys=keys, args=args)
+
+
+def membership_removed(room_id: int, user_id: int) -> None:
+    members = list(RoomMembership.objects.filter(room_id=room_id).values_list("user_id", flat=True))
+    redis_client().delete(*(_peers_key(uid) for uid in {user_id, *members}))
@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import pickle
+import weakref
+from importlib import import_module
+
+from channels.auth import get_user
+from channels.middleware import BaseMiddleware
+from channels.sessions import CookieMiddleware
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from redis import asyncio as aioredis
+from redis.exceptions import RedisError
+
+from .redis_client import redis_client
+
+logger = logging.getLogger(__name__)
+
+# 0 turns the cache off and resolves every handshake from the database.
+AUTH_CACHE_TTL = getattr(settings, "CHAT_AUTH_CACHE_TTL_SECONDS", 60)
+AUTH_CACHE_URL = getattr(settings, "CHAT_AUTH_CACHE_URL", settings.CACHES["default"]["LOCATION"])
+
+# session key -> pickled user (b"" for anonymous), plus a per-user set of
+# the session keys cached for it so a password change can drop them all.
+
+def _session_key(session_key: str) -> str:
+    return f"chat:auth:session:{session_key}"
+
+def _user_sessions_key(user_id) -> str:
+    return f"chat:auth:user:{user_id}:sessions"
+
+
+# redis.asyncio connections belong to the loop that opened them.
+_async_clients = weakref.WeakKeyDictionary()
+
+def _async_client():
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = aioredis.Redis.from_url(AUTH_CACHE_URL)
+    return client
+
+
+async def _cached_user(session_key: str):
+    try:
+        raw = await _async_client().get(_session_key(session_key))
+    except (RedisError, OSError):
+        logger.warning("Auth cache read failed", exc_info=True)
+        return None
+    if raw is None:
+        return None
+    return pickle.loads(raw) if raw else AnonymousUser()
+
+
+async def _cache_user(session_key: str, user) -> None:
+    key = _session_key(session_key)
+    try:
+        pipe = _async_client().pipeline(transaction=False)
+        if user.is_authenticated:
+            pipe.set(key, pickle.dumps(user), ex=AUTH_CACHE_TTL)
+            pipe.sadd(_user_sessions_key(user.pk), key)
+            pipe.expire(_user_sessions_key(user.pk), AUTH_CACHE_TTL)
+        else:
+            pipe.set(key, b"", ex=AUTH_CACHE_TTL)
+        await pipe.execute()
+    except (RedisError, OSError):
+        logger.warning("Auth cache write failed", exc_info=True)
+
+
+async def resolve_user(session):
+    """
+    The user for a session: from the cache when possible, otherwise one
+    database hop through channels.auth.get_user, whose result is cached.
+    """
+    session_key = session.session_key
+    if not session_key:
+        return AnonymousUser()
+    if not AUTH_CACHE_TTL:
+        return await get_user({"session": session})
+    user = await _cached_user(session_key)
+    if user is None:
+        user = await get_user({"session": session})
+        await _cache_user(session_key, user)
+    return user
+
+
+def invalidate_session(session_key: str) -> None:
+    if session_key:
+        redis_client().delete(_session_key(session_key))
+
+
+def invalidate_user(user_id) -> None:
+    """Drop every cached session of a user (password change, deactivation, ...)."""
+    client = redis_client()
+    keys = client.smembers(_user_sessions_key(user_id))
+    client.delete(_user_sessions_key(user_id), *keys)
+
+
+class CachedAuthMiddleware(BaseMiddleware):
+    """
+    Populates scope["session"] and scope["user"] for WebSocket handshakes.
+
+    Replaces channels' SessionMiddleware + AuthMiddleware pair: the session
+    store is built directly from the cookie (no thread hop) and the user is
+    looked up in Redis through an asyncio client, so a cached handshake
+    never touches the database or the sync thread. Entries live for
+    CHAT_AUTH_CACHE_TTL_SECONDS and are dropped on logout and on any save
+    of the user row (see chat.signals).
+    """
+    def __init__(self, inner):
+        super().__init__(inner)
+        self.session_store = import_module(settings.SESSION_ENGINE).SessionStore
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        session_key = scope.get("cookies", {}).get(settings.SESSION_COOKIE_NAME)
+        scope["session"] = self.session_store(session_key)
+        scope["user"] = await resolve_user(scope["session"])
+        return await super().__call__(scope, receive, send)
+
+
+def CachedAuthMiddlewareStack(inner):
+    return CookieMiddleware(CachedAuthMiddleware(inner))
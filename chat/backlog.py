@@ -0,0 +1,83 @@
+import json
+from typing import Dict, Iterable, List
+
+from django.conf import settings
+from redis.exceptions import WatchError
+
+from .encoding import dumps
+from .history import messages_before
+from .redis_client import redis_client
+from .serializers import MessageSerializer
+
+SIZE = getattr(settings, "CHAT_RECENT_MESSAGES", 50)
+BUFFER_TTL = getattr(settings, "CHAT_RECENT_TTL_SECONDS", 24 * 60 * 60)
+REBUILD_ATTEMPTS = getattr(settings, "CHAT_RECENT_REBUILD_ATTEMPTS", 3)
+
+# Per-room capped list of the last SIZE serialized messages, oldest first:
+#   chat:room:{id}:recent
+# Messages are appended with RPUSHX, so a missing buffer is never half
+# filled by new traffic; it is rebuilt from the database on first read.
+# Every push and invalidation also bumps
+#   chat:room:{id}:recent:version
+# which a rebuild WATCHes across its database read: a message committed
+# meanwhile finds no buffer to RPUSHX into, so the rebuild's write is
+# aborted and the read repeated rather than storing a list without it.
+
+def _recent_key(room_id: int) -> str:
+    return f"chat:room:{room_id}:recent"
+
+def _version_key(room_id: int) -> str:
+    return f"chat:room:{room_id}:recent:version"
+
+
+def push(message) -> None:
+    key = _recent_key(message.room_id)
+    pipe = redis_client().pipeline()
+    pipe.incr(_version_key(message.room_id))
+    pipe.rpushx(key, dumps(MessageSerializer(message).data))
+    pipe.ltrim(key, -SIZE, -1)
+    pipe.execute()
+
+def invalidate(room_id: int) -> None:
+    pipe = redis_client().pipeline()
+    pipe.incr(_version_key(room_id))
+    pipe.delete(_recent_key(room_id))
+    pipe.execute()
+
+def rebuild(room_id: int) -> List[dict]:
+    """
+    Reload the buffer from the database. After REBUILD_ATTEMPTS reads that
+    all raced a push, the last one is returned without being stored.
+    """
+    key = _recent_key(room_id)
+    with redis_client().pipeline() as pipe:
+        for _ in range(REBUILD_ATTEMPTS):
+            pipe.watch(_version_key(room_id))
+            messages = MessageSerializer(messages_before(room_id, limit=SIZE), many=True).data
+            pipe.multi()
+            pipe.delete(key)
+            if messages:
+                pipe.rpush(key, *(dumps(m) for m in messages))
+                pipe.expire(key, BUFFER_TTL)
+            try:
+                pipe.execute()
+            except WatchError:
+                continue
+            break
+    return list(messages)
+
+def recent_messages(room_id: int) -> List[dict]:
+    """Last SIZE messages of a room, oldest first, rebuilt from the DB if missing."""
+    raw = redis_client().lrange(_recent_key(room_id), 0, -1)
+    if not raw:
+        return rebuild(room_id)
+    return [json.loads(item) for item in raw]
+
+def recent_messages_many(room_ids: Iterable[int]) -> Dict[int, List[dict]]:
+    """recent_messages() of several rooms, read in one pipelined round trip."""
+    room_ids = list(room_ids)
+    pipe = redis_client().pipeline(transaction=False)
+    for room_id in room_ids:
+        pipe.lrange(_recent_key(room_id), 0, -1)
+    return {room_id: [json.loads(item) for item in raw] if raw else rebuild(room_id)
+            for room_id, raw in zip(room_ids, pipe.execute())}
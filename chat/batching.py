@@ -0,0 +1,32 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class WindowedBatch:
+    """
+    Base for in-process buffers that are flushed at most once per interval.
+    The flush task only runs while something is pending.
+    """
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._task = None
+
+    def _has_pending(self) -> bool:
+        raise NotImplementedError
+
+    async def flush(self) -> None:
+        raise NotImplementedError
+
+    def _schedule(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while self._has_pending():
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("%s flush failed", type(self).__name__)
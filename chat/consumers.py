@@ -1,39 +1,336 @@
-from channels.db import database_sync_to_async
 from djangochannelsrestframework.generics import GenericAsyncAPIConsumer
 from djangochannelsrestframework.observer import model_observer
 from djangochannelsrestframework.observer.generics import ObserverModelInstanceMixin
 from djangochannelsrestframework.decorators import action
+from django.conf import settings
 
-from .models import Room, Message
+from . import audience, ephemeral, metrics, persistence, wire
+from .archive import archiver, is_archiving
+from .backlog import recent_messages_many
+from .encoding import dumps, encode_fragment, with_request_id
+from .ephemeral import event_coalescer
+from .history import (
+    PAGE_SIZE, clamp_limit, messages_before, read_anchors,
+    resume_many, save_read_positions, unread_counts,
+)
+from .models import Room, RoomMembership, Message
+from .persistence import message_writer
+from .search import PAGE_SIZE as SEARCH_PAGE_SIZE, MAX_PAGE_SIZE as SEARCH_MAX_PAGE_SIZE, get_backend as search_backend
 from .serializers import RoomSerializer, MessageSerializer
+from .throttling import BoundedSendMixin, client_key, rate_limiter
+from .unread import read_position_writer
 
+JOIN_ROOMS_MAX = getattr(settings, "CHAT_JOIN_ROOMS_MAX", 100)
 
-class ChatConsumer(ObserverModelInstanceMixin, GenericAsyncAPIConsumer):
+
+class ChatConsumer(wire.WireProtocolMixin, BoundedSendMixin, ObserverModelInstanceMixin, GenericAsyncAPIConsumer):
     """
     WebSocket API:
-      - join_room: subscribe to message stream for a room
-      - leave_room: unsubscribe
+      - join_room: subscribe to message stream for a room; the reply
+        carries recent_messages from the per-room cache buffer. With
+        since_id (or a stored read position) it also carries the
+        missed_messages, or resync=true when the gap is too large
+      - join_rooms: join_room for a list of pks (since_ids maps pk ->
+        since_id), with all snapshots loaded in one batch and returned
+        in one frame. Unlike join_room it leaves read positions alone
+      - leave_room / leave_rooms: unsubscribe
+      - mark_read: move the read position of a room forward; messages
+        pushed to the socket are not marked read until the client says so
+      - send_event: ephemeral room signal such as typing; never stored,
+        coalesced into one room_events frame per room per window
+      - unread_counts: unread message counts for all of the user's rooms
+      - load_history: page of messages older than before_id (keyset)
+      - search_messages: ranked full-text search in a room (cursor paged)
       - create_message: persist a message (requires auth)
+    Clients offering the "chat.msgpack" subprotocol get msgpack frames and
+    compact message events (see chat.wire).
+    Actions listed in CHAT_RATE_LIMITS are token-bucket limited per user
+    and answered with 429 when the bucket is empty.
     Observer:
       - message_activity: pushes new messages to subscribers of that room
+    Group events:
+      - room_events: aggregated ephemeral events of a joined room
     """
-    queryset = Room.objects.all()
+    queryset = Room.objects.with_snapshot()
     serializer_class = RoomSerializer
     lookup_field = "pk"
 
-    @action() 
-    async def join_room(self, pk, request_id: str, **kwargs):
-        room = await database_sync_to_async(self.get_object)(pk=pk)
+    @classmethod
+    async def encode_json(cls, content):
+        return dumps(content)
+
+    async def handle_action(self, action: str, request_id: str, **kwargs):
+        if not rate_limiter.allow(client_key(self), action):
+            await self.reply(action=action, errors=["Rate limit exceeded"], status=429, request_id=request_id)
+            return
+        label = action if action in self.available_actions else "unknown"
+        with metrics.timed("chat_action_seconds", action=label):
+            await super().handle_action(action, request_id, **kwargs)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # room id -> id of the newest message this socket has delivered;
+        # message_activity skips anything up to it
+        self.delivered = {}
+        # room id -> newest message the client has read (join_room, mark_read),
+        # written on leave/disconnect. Delivery alone does not mark a message read.
+        self.read_positions = {}
+        # user ids already sent in full to a msgpack client
+        self.interned_users = set()
+        # room id -> ephemeral events this socket has switched on
+        self.ephemeral_state = {}
+
+    async def connect(self):
+        archiver.ensure_started()
+        await super().connect()
+
+    def frames_dropped(self):
+        # A discarded frame may have been the one defining a user.
+        self.interned_users.clear()
+
+    @staticmethod
+    def room_snapshots(rooms, since_ids: dict, anchors: dict) -> dict:
+        """
+        join_room payloads for rooms loaded with Room.objects.with_snapshot():
+        the serialized room, recent_messages and, when there is a position to
+        resume from (the client's since_id, else the stored read anchor),
+        missed_messages/resync. Recent buffers are read in one pipelined
+        round trip and missed messages in two queries for all rooms.
+        Returns {room_id: (data, read position)}.
+        """
+        recent = recent_messages_many(room.pk for room in rooms)
+        since = {}
+        for room in rooms:
+            since_id = since_ids.get(room.pk)
+            since[room.pk] = anchors.get(room.pk) if since_id is None else since_id
+        resumed = resume_many({pk: since_id for pk, since_id in since.items() if since_id is not None})
+        snapshots = {}
+        for room in rooms:
+            data = dict(RoomSerializer(room).data)
+            messages = data["recent_messages"] = recent[room.pk]
+            # The position is the newest message this payload actually carries,
+            # since message_activity skips everything up to it. room.last_message_id
+            # was read at another moment: behind the payload it re-sends messages,
+            # ahead of it it hides them.
+            position = messages[-1]["id"] if messages else None
+            if room.pk in resumed:
+                missed, resync = resumed[room.pk]
+                data["missed_messages"] = MessageSerializer(missed, many=True).data
+                data["resync"] = resync
+                if missed:
+                    position = max(position or 0, missed[-1].pk)
+            snapshots[room.pk] = data, position
+        return snapshots
+
+    def load_snapshots(self, user, pks, since_ids: dict):
+        """
+        room_snapshots() of the existing rooms among `pks`, plus those the
+        user is not a member of yet. Five queries whatever the number of
+        rooms: rooms with last_message, their memberships, the user's read
+        anchors, and the resume anchors and missed messages. Cold recent
+        buffers add one rebuild each.
+        """
+        rooms = list(self.queryset.filter(pk__in=pks))
+        anchors = read_anchors(user, pks) if user and user.is_authenticated else {}
+        snapshots = self.room_snapshots(rooms, since_ids, anchors)
+        return snapshots, [room.pk for room in rooms if room.pk not in anchors]
+
+    def joined(self, room_id: int, position: int | None, read: bool):
+        self.delivered[room_id] = position or 0
+        if read and position:
+            self.move_read_position(room_id, position)
 
+    @action()
+    async def join_room(self, pk, request_id: str, since_id: int | None = None, **kwargs):
+        try:
+            pk = int(pk)
+            since_id = None if since_id is None else int(since_id)
+        except (TypeError, ValueError):
+            return {"detail": "pk and since_id must be integers"}, 400
+        room = await metrics.db_hop(self.get_object, "get_object")(pk=pk)
+        user = self.scope.get("user")
+
+        # Subscribe before reading the replay so nothing committed in
+        # between is lost; message_activity drops what the replay covered.
         await self.message_activity.subscribe(room=room.pk, request_id=request_id)
-        data = await database_sync_to_async(lambda: RoomSerializer(room).data)() 
+        await self.add_group(ephemeral.group_name(room.pk))
+
+        def _snapshot():
+            anchors = read_anchors(user, [room.pk]) if user and user.is_authenticated else {}
+            data, position = self.room_snapshots([room], {room.pk: since_id}, anchors)[room.pk]
+            return data, position, room.pk in anchors
+
+        # The snapshot is read-only and runs on the read pool; only a first
+        # join needs the writer lane, to create the membership.
+        data, position, member = await metrics.db_hop(_snapshot, "join_room")()
+        if user and user.is_authenticated and not member:
+            await metrics.db_hop(RoomMembership.objects.get_or_create, "join_room_membership", write=True)(
+                room=room, user=user
+            )
+        # Opening one room reads it; join_rooms only subscribes.
+        self.joined(room.pk, position, read=True)
         return data, 200
 
+    @action()
+    async def join_rooms(self, pks, request_id: str, since_ids: dict | None = None, **kwargs):
+        try:
+            pks = list(dict.fromkeys(int(pk) for pk in pks))
+            since_ids = {int(pk): None if since is None else int(since) for pk, since in (since_ids or {}).items()}
+        except (TypeError, ValueError, AttributeError):
+            return {"detail": "pks and since_ids must be room ids mapped to message ids"}, 400
+        if len(pks) > JOIN_ROOMS_MAX:
+            return {"detail": f"at most {JOIN_ROOMS_MAX} rooms per join_rooms"}, 400
+        user = self.scope.get("user")
+        authenticated = bool(user and user.is_authenticated)
+
+        for pk in pks:
+            await self.message_activity.subscribe(room=pk, request_id=request_id)
+            await self.add_group(ephemeral.group_name(pk))
+
+        snapshots, new_members = await metrics.db_hop(self.load_snapshots, "join_rooms")(user, pks, since_ids)
+        missing = [pk for pk in pks if pk not in snapshots]
+        for pk in missing:
+            await self.message_activity.unsubscribe(room=pk)
+            await self.remove_group(ephemeral.group_name(pk))
+        if authenticated and new_members:
+            def _create_memberships():
+                RoomMembership.objects.bulk_create(
+                    [RoomMembership(room_id=pk, user=user) for pk in new_members], ignore_conflicts=True
+                )
+                # bulk_create() sends no post_save, so update the audiences here.
+                audience.memberships_added((pk, user.pk) for pk in new_members)
+
+            await metrics.db_hop(_create_memberships, "join_rooms_memberships", write=True)()
+        for pk, (_, position) in snapshots.items():
+            self.joined(pk, position, read=False)
+        return {"rooms": [data for data, _ in snapshots.values()], "missing": missing}, 200
+
     @action()
     async def leave_room(self, pk, **kwargs):
         await self.message_activity.unsubscribe(room=pk)
+        await self.remove_group(ephemeral.group_name(int(pk)))
+        self.clear_events(int(pk))
+        self.delivered.pop(int(pk), None)
+        await self.save_read_positions(int(pk))
         return {"left": pk}, 200
 
+    @action()
+    async def leave_rooms(self, pks, **kwargs):
+        pks = list(dict.fromkeys(int(pk) for pk in pks))
+        for pk in pks:
+            await self.message_activity.unsubscribe(room=pk)
+            await self.remove_group(ephemeral.group_name(pk))
+            self.clear_events(pk)
+            self.delivered.pop(pk, None)
+        await self.save_read_positions(*pks)
+        return {"left": pks}, 200
+
+    async def disconnect(self, code):
+        for room_id in list(self.ephemeral_state):
+            self.clear_events(room_id)
+        await self.save_read_positions(*self.read_positions)
+
+    @action()
+    async def send_event(self, pk, event: str = "", state=True, **kwargs):
+        user = self.scope.get("user")
+        if not user or not user.is_authenticated:
+            return {"detail": "Authentication required"}, 403
+        pk = int(pk)
+        if pk not in self.delivered:
+            return {"detail": "join_room first"}, 400
+        if event not in ephemeral.EVENTS:
+            return {"detail": f"event must be one of {list(ephemeral.EVENTS)}"}, 400
+        if not isinstance(state, (bool, int)):
+            return {"detail": "state must be a boolean or an integer"}, 400
+
+        active = self.ephemeral_state.setdefault(pk, set())
+        if state:
+            active.add(event)
+        else:
+            active.discard(event)
+        event_coalescer.add(pk, event, user.pk, user.username, state)
+        return {"room": pk, "event": event}, 200
+
+    def clear_events(self, room_id: int):
+        # Switch off whatever this socket left on, e.g. typing when the tab closes.
+        user = self.scope.get("user")
+        for event in self.ephemeral_state.pop(room_id, ()):
+            event_coalescer.add(room_id, event, user.pk, user.username, False)
+
+    async def room_events(self, event):
+        await self.send_json({"type": "room_events", "room": event["room"], "events": event["events"]})
+
+    async def save_read_positions(self, *room_ids):
+        user = self.scope.get("user")
+        positions = {rid: self.read_positions.pop(rid) for rid in room_ids if rid in self.read_positions}
+        positions = {rid: pk for rid, pk in positions.items() if pk}
+        if positions and user and user.is_authenticated:
+            for rid in positions:
+                read_position_writer.discard(user.pk, rid)
+            await metrics.db_hop(save_read_positions, "save_read_positions", write=True)(user, positions)
+
+    def move_read_position(self, room_id: int, message_id: int):
+        # Written by read_position_writer at most once per interval, and
+        # straight away when the room is left.
+        if message_id <= self.read_positions.get(room_id, 0):
+            return
+        self.read_positions[room_id] = message_id
+        user = self.scope.get("user")
+        if user and user.is_authenticated:
+            read_position_writer.update(user.pk, room_id, message_id)
+
+    @action()
+    async def mark_read(self, pk, message_id: int, **kwargs):
+        pk, message_id = int(pk), int(message_id)
+        self.move_read_position(pk, message_id)
+        return {"room": pk, "message_id": message_id}, 200
+
+    @action()
+    async def unread_counts(self, **kwargs):
+        user = self.scope.get("user")
+        if not user or not user.is_authenticated:
+            return {"detail": "Authentication required"}, 403
+        counts = await metrics.db_hop(unread_counts, "unread_counts")(user)
+        return {"unread": counts}, 200
+
+    @action()
+    async def load_history(self, pk, before_id: int | None = None, limit: int = PAGE_SIZE, **kwargs):
+        user = self.scope.get("user")
+        if not user or not user.is_authenticated:
+            return {"detail": "Authentication required"}, 403
+        try:
+            pk = int(pk)
+            before_id = None if before_id is None else int(before_id)
+        except (TypeError, ValueError):
+            return {"detail": "pk and before_id must be integers"}, 400
+        limit = clamp_limit(limit)
+
+        def _load():
+            return MessageSerializer(messages_before(pk, before_id, limit), many=True).data
+
+        messages = await metrics.db_hop(_load, "load_history")()
+        return {"room": pk, "messages": messages, "has_more": len(messages) == limit}, 200
+
+    @action()
+    async def search_messages(self, pk, query: str = "", cursor: str | None = None, limit: int = SEARCH_PAGE_SIZE, **kwargs):
+        user = self.scope.get("user")
+        if not user or not user.is_authenticated:
+            return {"detail": "Authentication required"}, 403
+        try:
+            pk, limit = int(pk), int(limit)
+        except (TypeError, ValueError):
+            return {"detail": "pk and limit must be integers"}, 400
+        limit = max(1, min(limit, SEARCH_MAX_PAGE_SIZE))
+
+        def _search():
+            results, next_cursor = search_backend().search(pk, query, cursor, limit)
+            return [
+                {**MessageSerializer(msg).data, "score": score} for msg, score in results
+            ], next_cursor
+
+        results, next_cursor = await metrics.db_hop(_search, "search_messages")()
+        return {"room": pk, "query": query, "results": results, "next_cursor": next_cursor}, 200
+
     @action()
     async def create_message(self, message: str = "", room: int | None = None, room_id: int | None = None, **kwargs):
         user = self.scope.get("user")
@@ -51,7 +348,11 @@ class ChatConsumer(ObserverModelInstanceMixin, GenericAsyncAPIConsumer):
                 return None
             return Message.objects.create(room=r, user=user, text=message)
 
-        msg = await database_sync_to_async(_create)()
+        # Read per call so the mode can be switched at runtime (loadtest does).
+        if persistence.WRITE_BEHIND:
+            msg = await message_writer.submit(int(rid), user, message)
+        else:
+            msg = await metrics.db_hop(_create, "create_message", write=True)()
         if msg is None:
             return {"detail": f"Room {rid} not found"}, 404
 
@@ -59,22 +360,51 @@ class ChatConsumer(ObserverModelInstanceMixin, GenericAsyncAPIConsumer):
 
     @model_observer(Message)
     async def message_activity(self, message, observer=None, subscribing_request_ids=list, **kwargs):
+        room, pk = message["room"], message["pk"]
+        if message["action"] == "create" and room in self.delivered:
+            # Already delivered by the join_room snapshot/replay.
+            if pk <= self.delivered[room]:
+                return
+            self.delivered[room] = pk
+        # The body was encoded once by the serializer below; only the
+        # request_id envelope is built per subscription.
+        if self.binary:
+            user = message["user"]
+            for request_id in subscribing_request_ids:
+                if user[0] in self.interned_users:
+                    frame = wire.message_frame(request_id, message["compact"])
+                else:
+                    frame = wire.message_frame(request_id, message["compact"], user)
+                    self.interned_users.add(user[0])
+                await self.send(bytes_data=frame)
+            return
+        fragment = message["fragment"]
         for request_id in subscribing_request_ids:
-            body = dict(request_id=request_id)
-            body.update(message)
-            await self.send_json(body)
+            await self.send(text_data=with_request_id(request_id, fragment))
 
     @message_activity.serializer
     def message_activity(self, instance: Message, action, **kwargs):
-        return dict(
-            data=MessageSerializer(instance).data,
-            action=action.value,
-            pk=instance.pk,
-        )
+        with metrics.timed("chat_observer_serialize_seconds", observer="message_activity"):
+            body = dict(
+                data=MessageSerializer(instance).data,
+                action=action.value,
+                pk=instance.pk,
+            )
+            return dict(
+                room=instance.room_id,
+                pk=instance.pk,
+                action=action.value,
+                fragment=encode_fragment(body),
+                compact=wire.message_fragment(instance, action.value),
+                user=[instance.user_id, instance.user.username],
+            )
 
     @message_activity.groups_for_signal
     def message_activity(self, instance: Message, **kwargs):
-        yield f"room__{instance.room_id}"
+        # Archived rows are loaded and deleted with no groups, so the
+        # observer has nothing to broadcast for them.
+        if not is_archiving():
+            yield f"room__{instance.room_id}"
 
     @message_activity.groups_for_consumer
     def message_activity(self, room=None, **kwargs):
@@ -84,13 +414,11 @@ class ChatConsumer(ObserverModelInstanceMixin, GenericAsyncAPIConsumer):
 
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from django.contrib.auth.models import AnonymousUser
-from django.conf import settings
-from asgiref.sync import sync_to_async
 
 from .presence import (
-    heartbeat, remove_global,
-    room_join, room_leave,
-    list_online_user_ids, room_online_user_ids
+    heartbeat, heartbeat_batcher, broadcaster, remove_global,
+    room_join, room_leave, room_group_name, user_group_name, sweeper,
+    interested_online_user_ids, room_online_user_ids
 )
 
 HB_SECONDS = getattr(settings, "PRESENCE_HEARTBEAT_SECONDS", 20)
@@ -98,60 +426,69 @@ HB_SECONDS = getattr(settings, "PRESENCE_HEARTBEAT_SECONDS", 20)
 def _uid(user):
     return getattr(user, "id", None)
 
-class PresenceConsumer(AsyncJsonWebsocketConsumer):
+class PresenceConsumer(wire.WireProtocolMixin, BoundedSendMixin, AsyncJsonWebsocketConsumer):
     """
     ws://.../ws/presence/
     - requires authenticated user
     - client should send {"type":"heartbeat"} every HB_SECONDS
+    - client may send {"type":"watch"|"unwatch", "user_ids":[...]} to follow
+      users it shares no room with, and {"type":"get_all"} to refresh
     - server can send:
         {"type":"all_online", "user_ids":[...], "heartbeat_every":HB_SECONDS}
-        {"type":"presence_event", "event":"online|offline", "user_id":...}
+        {"type":"presence_batch", "online":[...], "offline":[...]}
+      Both only cover the user's interest set: users sharing a room with
+      them plus the ones they watch (see chat.audience). presence_batch is
+      sent at most once per PRESENCE_BROADCAST_WINDOW_SECONDS.
     """
-    group_name = "presence_global"
-
     async def connect(self):
         user = self.scope.get("user", AnonymousUser())
         if not user or not user.is_authenticated:
             await self.close(code=4001)
             return
 
+        self.group_name = user_group_name(_uid(user))
         await self.accept()
         await self.channel_layer.group_add(self.group_name, self.channel_name)
+        sweeper.ensure_started()
 
-        await sync_to_async(heartbeat)(_uid(user))
-        await self.channel_layer.group_send(self.group_name, {
-            "type": "presence.update",
-            "payload": {"event": "online", "user_id": _uid(user)}
-        })
+        await metrics.thread_hop(heartbeat, "heartbeat")(_uid(user))
+        broadcaster.online(_uid(user))
+        await self.send_all_online(user)
 
-        ids = await sync_to_async(list_online_user_ids)()
+    async def send_all_online(self, user):
+        ids = await metrics.db_hop(interested_online_user_ids, "interested_online_user_ids")(_uid(user))
         await self.send_json({"type": "all_online", "user_ids": ids, "heartbeat_every": HB_SECONDS})
 
     async def disconnect(self, code):
         user = self.scope.get("user", AnonymousUser())
         if user and user.is_authenticated:
-            await sync_to_async(remove_global)(_uid(user))
-            await self.channel_layer.group_send(self.group_name, {
-                "type": "presence.update",
-                "payload": {"event": "offline", "user_id": _uid(user)}
-            })
-        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+            await metrics.thread_hop(remove_global, "remove_global")(_uid(user))
+            broadcaster.offline(_uid(user))
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
 
     async def receive_json(self, content, **kwargs):
         user = self.scope.get("user", AnonymousUser())
         if not user or not user.is_authenticated:
             return
-        if content.get("type") == "heartbeat":
-            await sync_to_async(heartbeat)(_uid(user))
-        elif content.get("type") == "get_all":
-            ids = await sync_to_async(list_online_user_ids)()
-            await self.send_json({"type": "all_online", "user_ids": ids, "heartbeat_every": HB_SECONDS})
+        kind = content.get("type")
+        if kind == "heartbeat":
+            heartbeat_batcher.add(_uid(user))
+        elif kind == "get_all":
+            await self.send_all_online(user)
+        elif kind in ("watch", "unwatch"):
+            try:
+                user_ids = [int(uid) for uid in content.get("user_ids", [])]
+            except (TypeError, ValueError):
+                return
+            change = audience.watch if kind == "watch" else audience.unwatch
+            await metrics.thread_hop(change, kind)(_uid(user), user_ids)
+            await self.send_all_online(user)
 
-    async def presence_update(self, event):
-        await self.send_json({"type": "presence_event", **event["payload"]})
+    async def presence_batch(self, event):
+        await self.send_json({"type": "presence_batch", "online": event["online"], "offline": event["offline"]})
 
 
-class RoomPresenceConsumer(AsyncJsonWebsocketConsumer):
+class RoomPresenceConsumer(wire.WireProtocolMixin, BoundedSendMixin, AsyncJsonWebsocketConsumer):
     """
     ws://.../ws/room/<room_id>/presence/
     Track presence of users inside a specific room.
@@ -163,34 +500,35 @@ class RoomPresenceConsumer(AsyncJsonWebsocketConsumer):
             await self.close(code=4001)
             return
 
-        self.group_name = f"presence_room_{self.room_id}"
+        self.group_name = room_group_name(self.room_id)
         await self.accept()
         await self.channel_layer.group_add(self.group_name, self.channel_name)
+        sweeper.ensure_started()
 
-        await sync_to_async(room_join)(_uid(user), self.room_id)
+        await metrics.thread_hop(room_join, "room_join")(_uid(user), self.room_id)
 
-        await self.channel_layer.group_send(self.group_name, {
+        await metrics.group_send(self.channel_layer, self.group_name, {
             "type": "presence.update",
             "payload": {"event": "room_join", "user_id": _uid(user), "room_id": self.room_id}
-        })
+        }, kind="presence_room")
 
-        ids = await sync_to_async(room_online_user_ids)(self.room_id)
+        ids = await metrics.thread_hop(room_online_user_ids, "room_online_user_ids")(self.room_id)
         await self.send_json({"type": "room_online", "room_id": self.room_id, "user_ids": ids, "heartbeat_every": HB_SECONDS})
 
     async def disconnect(self, code):
         user = self.scope.get("user", AnonymousUser())
         if user and user.is_authenticated:
-            await sync_to_async(room_leave)(_uid(user), self.room_id)
-            await self.channel_layer.group_send(self.group_name, {
+            await metrics.thread_hop(room_leave, "room_leave")(_uid(user), self.room_id)
+            await metrics.group_send(self.channel_layer, self.group_name, {
                 "type": "presence.update",
                 "payload": {"event": "room_leave", "user_id": _uid(user), "room_id": self.room_id}
-            })
+            }, kind="presence_room")
         await self.channel_layer.group_discard(self.group_name, self.channel_name)
 
     async def receive_json(self, content, **kwargs):
         user = self.scope.get("user", AnonymousUser())
         if user and user.is_authenticated and content.get("type") == "heartbeat":
-            await sync_to_async(heartbeat)(_uid(user))
+            heartbeat_batcher.add(_uid(user))
 
     async def presence_update(self, event):
         await self.send_json({"type": "presence_event", **event["payload"]})
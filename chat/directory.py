@@ -0,0 +1,108 @@
+import json
+from typing import Optional, Tuple
+
+from django.conf import settings
+
+from .encoding import dumps
+from .models import Room
+from .redis_client import redis_client
+
+PAGE_SIZE = getattr(settings, "CHAT_DIRECTORY_PAGE_SIZE", 50)
+MAX_PAGE_SIZE = getattr(settings, "CHAT_DIRECTORY_MAX_PAGE_SIZE", 200)
+# 0 turns the page cache off and queries the database on every request.
+CACHE_TTL = getattr(settings, "CHAT_DIRECTORY_CACHE_TTL_SECONDS", 300)
+
+# "name": every room, A-Z. "active": rooms with messages, most recent first.
+ORDERINGS = ("name", "active")
+
+# Pages are cached under the current generation counters:
+#   chat:directory:gen:rooms      bumped when a room is created, renamed or deleted
+#   chat:directory:gen:activity   bumped when a message is posted or removed
+# so invalidation is one INCR and stale pages simply age out. Name-ordered
+# pages only carry room fields and ignore the activity counter, which keeps
+# them cached under message traffic.
+
+_ROOMS_GEN = "chat:directory:gen:rooms"
+_ACTIVITY_GEN = "chat:directory:gen:activity"
+
+def _page_key(order: str, rooms_gen, activity_gen, prefix: str, cursor, limit: int) -> str:
+    # prefix and cursor are free-form, so they go last and JSON-encoded.
+    return f"chat:directory:{order}:{rooms_gen}:{activity_gen}:{limit}:{dumps([prefix, cursor])}"
+
+
+def clamp_limit(limit) -> int:
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def _prefix_range(prefix: str) -> Tuple[str, str]:
+    """Bounds of the names starting with `prefix`, so the lookup seeks the unique name index."""
+    return prefix, prefix[:-1] + chr(min(ord(prefix[-1]) + 1, 0x10FFFF))
+
+
+def query_page(order: str, prefix: str = "", cursor: Optional[str] = None, limit: int = PAGE_SIZE) -> dict:
+    """
+    One directory page straight from the database. Keyset-paginated: the
+    cursor is the last room name ("name") or last message id ("active") of
+    the previous page, so deep pages cost the same as the first.
+    """
+    qs = Room.objects.all()
+    if prefix:
+        low, high = _prefix_range(prefix)
+        # The range uses the index; startswith keeps collation quirks out.
+        qs = qs.filter(name__gte=low, name__lt=high, name__startswith=prefix)
+
+    if order == "name":
+        if cursor:
+            qs = qs.filter(name__gt=cursor)
+        rows = list(qs.order_by("name").values("id", "name")[:limit + 1])
+        next_cursor = rows[limit - 1]["name"] if len(rows) > limit else None
+        rooms = rows[:limit]
+    else:
+        qs = qs.filter(last_message__isnull=False)
+        try:
+            qs = qs.filter(last_message_id__lt=int(cursor)) if cursor else qs
+        except ValueError:
+            pass
+        rows = list(qs.order_by("-last_message_id")
+                    .values_list("id", "name", "last_message_id", "last_message__created_at")[:limit + 1])
+        next_cursor = str(rows[limit - 1][2]) if len(rows) > limit else None
+        rooms = [{"id": pk, "name": name, "last_message_id": message_id, "last_activity": created_at.isoformat()}
+                 for pk, name, message_id, created_at in rows[:limit]]
+    return {"order": order, "prefix": prefix, "rooms": rooms, "next_cursor": next_cursor}
+
+
+def rooms_page(order: str = "name", prefix: str = "", cursor: Optional[str] = None, limit=PAGE_SIZE) -> dict:
+    """query_page() through the Redis page cache; raises ValueError for an unknown order."""
+    if order not in ORDERINGS:
+        raise ValueError(f"Unknown room ordering {order!r}")
+    prefix = (prefix or "")[:Room._meta.get_field("name").max_length]
+    cursor = cursor or None
+    limit = clamp_limit(limit)
+    if not CACHE_TTL:
+        return query_page(order, prefix, cursor, limit)
+
+    client = redis_client()
+    # Read the generations before querying: a bump that races the query
+    # leaves the page under a key nobody will ask for again.
+    rooms_gen, activity_gen = client.mget(_ROOMS_GEN, _ACTIVITY_GEN)
+    rooms_gen = int(rooms_gen or 0)
+    activity_gen = int(activity_gen or 0) if order == "active" else "-"
+    key = _page_key(order, rooms_gen, activity_gen, prefix, cursor, limit)
+    raw = client.get(key)
+    if raw is not None:
+        return json.loads(raw)
+    page = query_page(order, prefix, cursor, limit)
+    client.set(key, dumps(page), ex=CACHE_TTL)
+    return page
+
+
+def rooms_changed() -> None:
+    redis_client().incr(_ROOMS_GEN)
+
+
+def activity_changed() -> None:
+    redis_client().incr(_ACTIVITY_GEN)
@@ -0,0 +1,30 @@
+import json
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+@lru_cache(maxsize=None)
+def _dumps():
+    # CHAT_JSON_DUMPS is a dotted path to a dumps(obj) callable, e.g.
+    # "orjson.dumps". Callables returning bytes are accepted too.
+    path = getattr(settings, "CHAT_JSON_DUMPS", None)
+    return import_string(path) if path else json.dumps
+
+
+def dumps(obj) -> str:
+    out = _dumps()(obj)
+    return out.decode() if isinstance(out, bytes) else out
+
+
+def encode_fragment(obj: dict) -> str:
+    """Encode a dict as JSON object members without the enclosing braces."""
+    return dumps(obj)[1:-1]
+
+
+def with_request_id(request_id, fragment: str) -> str:
+    """Wrap a pre-encoded fragment in an object that leads with request_id."""
+    if not fragment:
+        return '{"request_id":%s}' % dumps(request_id)
+    return '{"request_id":%s,%s}' % (dumps(request_id), fragment)
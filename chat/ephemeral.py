@@ -0,0 +1,49 @@
+from typing import Dict, Tuple
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import metrics
+from .batching import WindowedBatch
+
+EVENTS = getattr(settings, "CHAT_EPHEMERAL_EVENTS", ("typing", "viewing"))
+WINDOW_SECONDS = getattr(settings, "CHAT_EPHEMERAL_WINDOW_SECONDS", 0.5)
+
+
+def group_name(room_id: int) -> str:
+    return f"room_{room_id}_events"
+
+
+class EventCoalescer(WindowedBatch):
+    """
+    Collects ephemeral room events (typing, viewing, ...) during a window
+    and sends each room a single room.events message carrying the latest
+    state per (event, user). Nothing here touches the database.
+    """
+    def __init__(self, interval: float = WINDOW_SECONDS):
+        super().__init__(interval)
+        # room id -> {(event, user id): (username, state)}
+        self._pending: Dict[int, Dict[Tuple[str, int], tuple]] = {}
+
+    def add(self, room_id: int, event: str, user_id: int, username: str, state) -> None:
+        self._pending.setdefault(room_id, {})[(event, user_id)] = (username, state)
+        self._schedule()
+
+    def _has_pending(self) -> bool:
+        return bool(self._pending)
+
+    async def flush(self) -> None:
+        pending, self._pending = self._pending, {}
+        layer = get_channel_layer()
+        for room_id, events in pending.items():
+            await metrics.group_send(layer, group_name(room_id), {
+                "type": "room.events",
+                "room": room_id,
+                "events": [
+                    {"event": event, "user": [user_id, username], "state": state}
+                    for (event, user_id), (username, state) in events.items()
+                ],
+            }, kind="room_events")
+
+
+event_coalescer = EventCoalescer()
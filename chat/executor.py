@@ -0,0 +1,33 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+# Threads for read-only ORM work; 0 sends every call through channels'
+# single thread-sensitive executor, as database_sync_to_async does by default.
+READ_WORKERS = getattr(settings, "CHAT_DB_READ_WORKERS", 0)
+
+_read_pool = None
+_write_pool = None
+
+
+def _pools():
+    global _read_pool, _write_pool
+    if _read_pool is None:
+        _read_pool = ThreadPoolExecutor(READ_WORKERS, thread_name_prefix="chat-db-read")
+        # One writer lane: writes never contend with each other for the
+        # database lock, and the thread keeps its connection between calls.
+        _write_pool = ThreadPoolExecutor(1, thread_name_prefix="chat-db-write")
+    return _read_pool, _write_pool
+
+
+def database_hop(func, write: bool = False):
+    """
+    database_sync_to_async(func) on the read pool, or on the writer lane
+    when `write` is set. Worker threads are long-lived, so with CONN_MAX_AGE
+    each keeps and reuses its own connection.
+    """
+    if not READ_WORKERS:
+        return database_sync_to_async(func)
+    read_pool, write_pool = _pools()
+    return database_sync_to_async(func, thread_sensitive=False, executor=write_pool if write else read_pool)
@@ -0,0 +1,137 @@
+from typing import Dict, List, Optional, Tuple
+from django.conf import settings
+from django.db.models import Count, F, OuterRef, Q, Subquery, Window
+from django.db.models.functions import Coalesce, RowNumber
+
+from . import archive
+from .models import Message, RoomMembership
+
+PAGE_SIZE = getattr(settings, "CHAT_HISTORY_PAGE_SIZE", 50)
+MAX_PAGE_SIZE = getattr(settings, "CHAT_HISTORY_MAX_PAGE_SIZE", 200)
+RESUME_MAX_MESSAGES = getattr(settings, "CHAT_RESUME_MAX_MESSAGES", 200)
+
+
+def clamp_limit(limit) -> int:
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def messages_before(room_id: int, before_id: Optional[int] = None, limit: int = PAGE_SIZE) -> List[Message]:
+    """
+    Return up to `limit` messages of a room older than `before_id`, oldest first.
+
+    Seeks on the (room, created_at, id) index rather than using OFFSET, so
+    every page costs the same no matter how deep into the history it is.
+    Pages that run past the hot table continue into archived segments.
+    """
+    qs = Message.objects.filter(room_id=room_id).select_related("user")
+    if before_id is not None:
+        anchor = (Message.objects.filter(room_id=room_id, pk=before_id)
+                  .values_list("created_at", flat=True).first())
+        if anchor is None:
+            return archive.cold_messages_before(room_id, before_id, limit)
+        # Spelled as a range plus a tie-break exclusion so the database can
+        # seek the index on created_at instead of filtering an OR row by row.
+        qs = qs.filter(created_at__lte=anchor).exclude(created_at=anchor, pk__gte=before_id)
+    page = list(qs.order_by("-created_at", "-id")[:limit])
+    page.reverse()
+    if len(page) < limit:
+        page = archive.cold_messages_before(room_id, None, limit - len(page)) + page
+    return page
+
+
+def messages_after(room_id: int, after_id: Optional[int] = None, limit: int = PAGE_SIZE) -> Optional[List[Message]]:
+    """
+    Return up to `limit` messages of a room newer than `after_id`, oldest first.
+    Returns None when `after_id` is not a message of this room.
+    """
+    qs = Message.objects.filter(room_id=room_id).select_related("user")
+    if after_id is not None:
+        anchor = (Message.objects.filter(room_id=room_id, pk=after_id)
+                  .values_list("created_at", flat=True).first())
+        if anchor is None:
+            return None
+        qs = qs.filter(created_at__gte=anchor).exclude(created_at=anchor, pk__lte=after_id)
+    return list(qs.order_by("created_at", "id")[:limit])
+
+
+def read_anchors(user, room_ids) -> Dict[int, Optional[int]]:
+    """
+    {room_id: id of the newest message created at or before the user's
+    last_seen} for each of `room_ids` the user is a member of, in one query.
+    Rooms without a membership are left out.
+    """
+    newest = (Message.objects.filter(room_id=OuterRef("room_id"), created_at__lte=OuterRef("last_seen"))
+              .order_by("-created_at", "-id").values("pk")[:1])
+    return dict(RoomMembership.objects.filter(user=user, room_id__in=room_ids)
+                .annotate(anchor=Subquery(newest)).values_list("room_id", "anchor"))
+
+
+def resume(room_id: int, since_id: Optional[int], limit: int = RESUME_MAX_MESSAGES) -> Tuple[List[Message], bool]:
+    """
+    Messages a reconnecting client missed after `since_id`, plus a flag that
+    is True when the gap is too large (or unknown) and it should resync.
+    """
+    return resume_many({room_id: since_id}, limit)[room_id]
+
+
+def resume_many(since_ids: Dict[int, Optional[int]],
+                limit: int = RESUME_MAX_MESSAGES) -> Dict[int, Tuple[List[Message], bool]]:
+    """
+    resume() for {room_id: since_id} of several rooms: one query for the
+    anchors and one, ranked per room, for the missed messages.
+    """
+    found = {pk: (room_id, created_at) for pk, room_id, created_at in
+             Message.objects.filter(pk__in={pk for pk in since_ids.values() if pk is not None})
+             .values_list("pk", "room_id", "created_at")}
+    newer, missed = Q(), {}
+    for room_id, since_id in since_ids.items():
+        anchor = found.get(since_id)
+        if anchor is None or anchor[0] != room_id:
+            continue
+        created_at = anchor[1]
+        newer |= Q(room_id=room_id, created_at__gt=created_at) | Q(room_id=room_id, created_at=created_at, pk__gt=since_id)
+        missed[room_id] = []
+    if missed:
+        rank = Window(RowNumber(), partition_by=F("room_id"), order_by=[F("created_at").asc(), F("id").asc()])
+        rows = (Message.objects.filter(newer).select_related("user").annotate(rank=rank)
+                .filter(rank__lte=limit + 1).order_by("room_id", "created_at", "id"))
+        for message in rows:
+            missed[message.room_id].append(message)
+    resumed = {}
+    for room_id in since_ids:
+        messages = missed.get(room_id)
+        resumed[room_id] = ([], True) if messages is None or len(messages) > limit else (messages, False)
+    return resumed
+
+
+def save_read_positions(user, positions: Dict[int, int]) -> None:
+    """Move RoomMembership.last_seen forward to the given {room_id: message_id}."""
+    save_read_positions_many({(user.pk, room_id): message_id for room_id, message_id in positions.items()})
+
+
+def save_read_positions_many(positions: Dict[Tuple[int, int], int]) -> None:
+    """
+    Move last_seen forward for {(user_id, room_id): message_id} and reset
+    each membership's unread_count to what is still newer than that message.
+    The count is a subquery of the same UPDATE, so a message committed
+    concurrently is either counted here or by its own increment, never lost.
+    """
+    seen_at = dict(Message.objects.filter(pk__in=positions.values()).values_list("pk", "created_at"))
+    for (user_id, room_id), message_id in positions.items():
+        when = seen_at.get(message_id)
+        if when is None:
+            continue
+        newer = (Message.objects.filter(room_id=room_id, created_at__gt=when).exclude(user_id=user_id)
+                 .order_by().values("room_id").annotate(n=Count("pk")).values("n"))
+        RoomMembership.objects.filter(room_id=room_id, user_id=user_id, last_seen__lt=when).update(
+            last_seen=when, unread_count=Coalesce(Subquery(newer), 0),
+        )
+
+
+def unread_counts(user) -> Dict[int, int]:
+    """{room_id: unread_count} for every room the user is a member of, in one query."""
+    return dict(RoomMembership.objects.filter(user=user).values_list("room_id", "unread_count"))
@@ -0,0 +1,134 @@
+import asyncio
+import collections
+import functools
+import time
+from typing import Dict
+
+from channels_redis.core import BoundedQueue, RedisChannelLayer
+
+FANOUT_TYPE = "chat.layer_fanout"
+
+
+class NodeLocalRedisChannelLayer(RedisChannelLayer):
+    """
+    RedisChannelLayer that keeps group membership per process.
+
+    The first local consumer to join a group adds one node channel for
+    the whole process to the Redis group; later joins are only recorded
+    in memory. group_send therefore reaches each process once, however
+    many of its consumers are in the group, and the node channel copies
+    the message into a per-channel local queue. receive() waits on that
+    queue and on the normal Redis receive at once. channels_redis' own
+    receive buffer is never written from outside its receive path: the
+    coroutine holding its receive lock sits in BZPOPMIN and would not see
+    such a message until unrelated Redis traffic arrived.
+
+    Group and channel keys are sharded over CONFIG["hosts"] by
+    channels_redis' consistent hash, so adding hosts spreads the groups.
+    Set CONFIG["local_fanout"] to False to get plain per-channel groups;
+    every process sharing the layer must use the same setting.
+    """
+    def __init__(self, *args, local_fanout: bool = True, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.local_fanout = local_fanout
+        # group -> {local channel: joined at}
+        self.local_groups: Dict[str, Dict[str, float]] = {}
+        self._node_channel = None
+        self._node_task = None
+        # Fanned-out messages per local channel, and the Redis receive each
+        # channel has in flight. That receive is never cancelled when a
+        # local message wins (cancelling drops channels_redis' buffer), so
+        # the next receive() picks up its result.
+        self._local_queues = collections.defaultdict(functools.partial(BoundedQueue, self.capacity))
+        self._remote_receives: Dict[str, asyncio.Future] = {}
+
+    async def _node(self) -> str:
+        if self._node_channel is None:
+            self._node_channel = await self.new_channel()
+        loop = asyncio.get_running_loop()
+        if self._node_task is None or self._node_task.done() or self._node_task.get_loop() is not loop:
+            self._node_task = loop.create_task(self._fan_out())
+        return self._node_channel
+
+    async def _fan_out(self):
+        while True:
+            envelope = await super().receive(self._node_channel)
+            members = self.local_groups.get(envelope["group"])
+            if not members:
+                continue
+            message = envelope["message"]
+            # Same expiry rule as the Redis side, for members that never discarded.
+            stale = time.time() - self.group_expiry
+            for channel, joined in list(members.items()):
+                if joined < stale:
+                    del members[channel]
+                else:
+                    self._local_queues[channel].put_nowait(message)
+
+    async def receive(self, channel):
+        if not self.local_fanout or "!" not in channel:
+            return await super().receive(channel)
+        local = self._local_queues[channel]
+        if local.empty():
+            remote = self._remote_receives.get(channel)
+            if remote is None:
+                remote = self._remote_receives[channel] = asyncio.ensure_future(super().receive(channel))
+            getter = asyncio.ensure_future(local.get())
+            try:
+                await asyncio.wait({remote, getter}, return_when=asyncio.FIRST_COMPLETED)
+            except asyncio.CancelledError:
+                getter.cancel()
+                self._remote_receives.pop(channel, None)
+                remote.cancel()
+                raise
+            if not getter.done():
+                getter.cancel()
+                # Cancelling Queue.get() never consumes an item; anything that
+                # arrived meanwhile is still in the queue.
+                del self._remote_receives[channel]
+                if local.empty():
+                    self._local_queues.pop(channel, None)
+                return remote.result()
+            message = getter.result()
+        else:
+            message = local.get_nowait()
+        if local.empty():
+            self._local_queues.pop(channel, None)
+        return message
+
+    async def group_add(self, group, channel):
+        if not self.local_fanout:
+            return await super().group_add(group, channel)
+        assert self.require_valid_group_name(group), "Group name not valid"
+        assert self.require_valid_channel_name(channel), "Channel name not valid"
+        node = await self._node()
+        self.local_groups.setdefault(group, {})[channel] = time.time()
+        # Re-adding on every join keeps the node's entry from expiring.
+        await super().group_add(group, node)
+
+    async def group_discard(self, group, channel):
+        if not self.local_fanout:
+            return await super().group_discard(group, channel)
+        members = self.local_groups.get(group)
+        if members is None:
+            return
+        members.pop(channel, None)
+        if not members:
+            del self.local_groups[group]
+            await super().group_discard(group, self._node_channel)
+
+    async def group_send(self, group, message):
+        if not self.local_fanout:
+            return await super().group_send(group, message)
+        await super().group_send(group, {"type": FANOUT_TYPE, "group": group, "message": message})
+
+    async def flush(self):
+        if self._node_task is not None:
+            self._node_task.cancel()
+            self._node_task = None
+        for remote in self._remote_receives.values():
+            remote.cancel()
+        self._remote_receives.clear()
+        self._local_queues.clear()
+        self.local_groups.clear()
+        await super().flush()
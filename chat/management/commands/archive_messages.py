@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.archive import ARCHIVE_AFTER_DAYS, SEGMENT_SIZE, archive_old_messages
+
+
+class Command(BaseCommand):
+    help = "Move old messages out of the hot table into compressed per-room archive segments."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--older-than-days", type=float, default=ARCHIVE_AFTER_DAYS)
+        parser.add_argument("--segment-size", type=int, default=SEGMENT_SIZE)
+        parser.add_argument("--room", type=int, action="append", help="only archive this room (repeatable)")
+        parser.add_argument("--every", type=float, default=0,
+                            help="keep running, archiving every N seconds")
+
+    def handle(self, *args, **opts):
+        while True:
+            started = time.perf_counter()
+            archived = archive_old_messages(opts["older_than_days"], opts["segment_size"], opts["room"])
+            elapsed = time.perf_counter() - started
+            for room_id, count in sorted(archived.items()):
+                self.stdout.write(f"room {room_id}: archived {count} messages")
+            self.stdout.write(self.style.SUCCESS(
+                f"Archived {sum(archived.values())} messages from {len(archived)} rooms in {elapsed:.2f}s."
+            ))
+            if not opts["every"]:
+                break
+            time.sleep(opts["every"])
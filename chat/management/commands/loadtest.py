@@ -0,0 +1,479 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.utils import override_settings, setup_databases, teardown_databases
+
+User = get_user_model()
+
+
+def _percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+
+    return {"count": len(ordered), "p50_ms": pick(0.50), "p99_ms": pick(0.99), "max_ms": pick(1.0)}
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive the ASGI application with simulated WebSocket clients and write "
+        "throughput and latency figures as JSON. Runs against a throwaway test "
+        "database and, by default, an in-memory channel layer."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", type=int, default=10)
+        parser.add_argument("--room-size", type=int, default=50, help="clients per room")
+        parser.add_argument("--messages", type=int, default=20, help="messages sent per room")
+        parser.add_argument("--concurrency", type=int, default=200, help="parallel handshakes")
+        parser.add_argument("--timeout", type=float, default=30.0)
+        parser.add_argument("--channel-layer", choices=["memory", "configured", "fakeredis"], default="memory",
+                            help="fakeredis runs the configured layer against an in-process Redis stand-in")
+        parser.add_argument("--no-local-fanout", action="store_true",
+                            help="turn off node-local group fan-out in the configured layer")
+        parser.add_argument("--keep-rate-limits", action="store_true",
+                            help="leave CHAT_RATE_LIMITS in force (429s are counted)")
+        parser.add_argument("--mixed-ops", type=int, default=5,
+                            help="create_message + join_room pairs per client in the mixed round (0 skips it)")
+        parser.add_argument("--db-read-workers", type=int,
+                            help="override CHAT_DB_READ_WORKERS (0 = channels' single DB thread)")
+        parser.add_argument("--write-behind", type=int, default=0, metavar="N",
+                            help="create_message round: every client sends N messages and waits for each ack, "
+                                 "once directly and once with CHAT_MESSAGE_WRITE_BEHIND (0 skips it)")
+        parser.add_argument("--encode-subscribers", type=int, default=10_000,
+                            help="subscriptions in the message_activity encode micro-benchmark (0 skips it)")
+        parser.add_argument("--skip-presence", action="store_true")
+        parser.add_argument("--skip-handshakes", action="store_true",
+                            help="skip the cold/warm reconnect-storm handshake rounds")
+        parser.add_argument("--output", help="write JSON here instead of stdout")
+
+    def handle(self, *args, **opts):
+        layers = settings.CHANNEL_LAYERS
+        if opts["channel_layer"] == "memory":
+            layers = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer",
+                                  "CONFIG": {"capacity": 100_000}}}
+        elif opts["channel_layer"] == "fakeredis":
+            layers = self._fakeredis_layers(layers)
+        if opts["no_local_fanout"]:
+            layers = {name: {**layer, "CONFIG": {**layer.get("CONFIG", {}), "local_fanout": False}}
+                      for name, layer in layers.items()}
+
+        if opts["db_read_workers"] is not None:
+            from chat import executor
+            executor.READ_WORKERS = opts["db_read_workers"]
+        # An on-disk test database, so WAL and the executor's parallel
+        # readers behave as they do in production.
+        for conn in connections.all():
+            if conn.vendor == "sqlite" and not conn.settings_dict["TEST"]["NAME"]:
+                conn.settings_dict["TEST"]["NAME"] = os.path.join(tempfile.mkdtemp(), "loadtest.sqlite3")
+
+        with override_settings(CHANNEL_LAYERS=layers):
+            db_config = setup_databases(verbosity=0, interactive=False)
+            try:
+                rooms = self._create_fixtures(opts["rooms"], opts["room_size"])
+                if not opts["keep_rate_limits"]:
+                    from chat.throttling import rate_limiter
+                    rate_limiter.limits = {}
+                report = asyncio.run(self._run(rooms, opts))
+                if opts["encode_subscribers"]:
+                    report["encode"] = self._run_encode(opts["encode_subscribers"])
+            finally:
+                teardown_databases(db_config, verbosity=0)
+
+        report["config"] = {key: opts[key] for key in (
+            "rooms", "room_size", "messages", "concurrency", "channel_layer", "no_local_fanout",
+            "mixed_ops", "keep_rate_limits", "write_behind", "encode_subscribers")}
+        from chat import executor
+        report["config"]["db_read_workers"] = executor.READ_WORKERS
+        output = json.dumps(report, indent=2)
+        if opts["output"]:
+            with open(opts["output"], "w") as fh:
+                fh.write(output + "\n")
+        else:
+            self.stdout.write(output)
+
+    def _fakeredis_layers(self, layers):
+        try:
+            from fakeredis import TcpFakeServer
+        except ImportError:
+            raise CommandError("--channel-layer fakeredis needs the fakeredis package (and lupa).")
+        server = TcpFakeServer(("127.0.0.1", 0), server_type="redis")
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host, port = server.server_address
+        return {name: {**layer, "CONFIG": {**layer.get("CONFIG", {}), "hosts": [(host, port)]}}
+                for name, layer in layers.items()}
+
+    def _create_fixtures(self, room_count, room_size):
+        from chat.models import Room
+
+        users = User.objects.bulk_create([
+            User(username=f"loadtest-{i}", password="!") for i in range(room_count * room_size)
+        ])
+        rooms = Room.objects.bulk_create([Room(name=f"loadtest-{i}") for i in range(room_count)])
+        fixtures = []
+        for index, room in enumerate(rooms):
+            keys = []
+            for user in users[index * room_size:(index + 1) * room_size]:
+                session = SessionStore()
+                session[SESSION_KEY] = str(user.pk)
+                session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+                session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+                session.create()
+                keys.append(session.session_key)
+            fixtures.append((room.pk, keys))
+        return fixtures
+
+    async def _run(self, rooms, opts):
+        from channels.testing import WebsocketCommunicator
+        from dcrf_messenger.asgi import application
+
+        timeout = opts["timeout"]
+        gate = asyncio.Semaphore(opts["concurrency"])
+        cookie = settings.SESSION_COOKIE_NAME
+
+        async def open_socket(path, session_key):
+            comm = WebsocketCommunicator(application, path, headers=[
+                (b"cookie", f"{cookie}={session_key}".encode()),
+            ])
+            connected, _ = await comm.connect(timeout=timeout)
+            if not connected:
+                raise RuntimeError(f"handshake rejected for {path}")
+            return comm
+
+        report = {}
+        if not opts["skip_handshakes"]:
+            report["handshake"] = await self._run_handshakes(rooms, open_socket, gate)
+
+        # --- chat: connect + join_room -------------------------------------
+        join_latencies, errors = [], []
+
+        async def join(room_id, session_key):
+            async with gate:
+                comm = await open_socket("/ws/chat/room/", session_key)
+                started = time.perf_counter()
+                await comm.send_json_to({"action": "join_room", "pk": room_id, "request_id": "join"})
+                reply = await comm.receive_json_from(timeout=timeout)
+                if reply.get("response_status") != 200:
+                    errors.append(reply.get("errors"))
+                join_latencies.append(time.perf_counter() - started)
+                return room_id, comm
+
+        started = time.perf_counter()
+        clients = await asyncio.gather(*(join(room_id, key) for room_id, keys in rooms for key in keys))
+        connect_seconds = time.perf_counter() - started
+
+        # --- chat: fan-out -------------------------------------------------
+        per_room = opts["messages"]
+        fanout_latencies, throttled = [], []
+        delivered = 0
+
+        async def receive(comm):
+            nonlocal delivered
+            got = 0
+            try:
+                while got < per_room:
+                    frame = await comm.receive_json_from(timeout=timeout)
+                    if frame.get("response_status") == 429:
+                        throttled.append(1)
+                    if frame.get("action") != "create" or "data" not in frame:
+                        continue
+                    sent_at = float(frame["data"]["text"].split(":", 1)[1])
+                    fanout_latencies.append(time.perf_counter() - sent_at)
+                    got += 1
+            except asyncio.TimeoutError:
+                pass
+            delivered += got
+
+        by_room = {}
+        for room_id, comm in clients:
+            by_room.setdefault(room_id, []).append(comm)
+
+        async def send(room_id, members):
+            for i in range(per_room):
+                sender = members[i % len(members)]
+                await sender.send_json_to({
+                    "action": "create_message", "room": room_id,
+                    "message": f"loadtest:{time.perf_counter()!r}",
+                })
+
+        receivers = [asyncio.ensure_future(receive(comm)) for _, comm in clients]
+        started = time.perf_counter()
+        await asyncio.gather(*(send(room_id, members) for room_id, members in by_room.items()))
+        await asyncio.gather(*receivers)
+        fanout_seconds = time.perf_counter() - started
+        mixed = await self._run_mixed(clients, opts["mixed_ops"], timeout) if opts["mixed_ops"] else None
+        writes = await self._run_writes(clients, opts["write_behind"], timeout) if opts["write_behind"] else None
+        await asyncio.gather(*(comm.disconnect() for _, comm in clients))
+
+        sent = per_room * len(by_room)
+        report.update({
+            "chat": {
+                "clients": len(clients),
+                "connect_seconds": round(connect_seconds, 3),
+                "join_latency": _percentiles(join_latencies),
+                "join_errors": len(errors),
+                "messages_sent": sent,
+                "frames_expected": sent * opts["room_size"],
+                "frames_delivered": delivered,
+                "throttled": len(throttled),
+                "fanout_seconds": round(fanout_seconds, 3),
+                "messages_per_sec": round(sent / fanout_seconds, 1) if fanout_seconds else None,
+                "deliveries_per_sec": round(delivered / fanout_seconds, 1) if fanout_seconds else None,
+                "fanout_latency": _percentiles(fanout_latencies),
+            },
+        })
+        if mixed:
+            report["mixed"] = mixed
+        if writes:
+            report["writes"] = writes
+        if not opts["skip_presence"]:
+            report["presence"] = await self._run_presence(rooms, open_socket, gate, timeout)
+            # Same storm without and with the broadcast window, for a before/after pair.
+            report["presence_storm"] = {
+                "unbatched": await self._run_presence_storm(rooms, open_socket, gate, timeout, window=0),
+                "batched": await self._run_presence_storm(rooms, open_socket, gate, timeout),
+            }
+        return report
+
+    def _run_encode(self, subscribers):
+        """
+        CPU time per delivered frame when one message reaches `subscribers`
+        subscriptions: json.dumps of the whole frame per subscriber, as
+        message_activity used to do, against encoding the body once with
+        CHAT_JSON_DUMPS and splicing in each request_id.
+        """
+        from django.utils import timezone
+
+        from chat.encoding import encode_fragment, with_request_id
+        from chat.models import Message
+        from chat.serializers import MessageSerializer
+
+        user = User(pk=1, username="loadtest-0")
+        message = Message(pk=1, room_id=1, user=user, text="loadtest encode " * 8, created_at=timezone.now())
+        request_ids = [f"join-{i}" for i in range(subscribers)]
+
+        def per_subscriber():
+            body = dict(data=MessageSerializer(message).data, action="create", pk=message.pk)
+            return [json.dumps(dict(body, request_id=request_id)) for request_id in request_ids]
+
+        def encode_once():
+            fragment = encode_fragment(dict(data=MessageSerializer(message).data, action="create", pk=message.pk))
+            return [with_request_id(request_id, fragment) for request_id in request_ids]
+
+        results = {"subscribers": subscribers,
+                   "json_dumps": getattr(settings, "CHAT_JSON_DUMPS", None) or "json.dumps"}
+        frames = {}
+        for name, encode in (("per_subscriber", per_subscriber), ("encode_once", encode_once)):
+            started = time.process_time()
+            frames[name] = encode()
+            elapsed = time.process_time() - started
+            results[name] = {"cpu_seconds": round(elapsed, 4), "us_per_frame": round(elapsed / subscribers * 1e6, 3)}
+        results["frames_match"] = all(json.loads(a) == json.loads(b) for a, b in zip(*frames.values()))
+        return results
+
+    async def _run_mixed(self, clients, ops, timeout):
+        """
+        Every joined client alternates create_message and join_room, all at
+        once: concurrent writes and read-heavy snapshots on the DB executor.
+        """
+        latencies = {"create_message": [], "join_room": []}
+
+        async def call(comm, action, **payload):
+            started = time.perf_counter()
+            # join_room reuses the original request_id so the subscription is not duplicated.
+            await comm.send_json_to({"action": action, "request_id": "join", **payload})
+            while True:
+                frame = await comm.receive_json_from(timeout=timeout)
+                if frame.get("action") == action and "response_status" in frame:
+                    break
+            latencies[action].append(time.perf_counter() - started)
+
+        async def client(room_id, comm):
+            for i in range(ops):
+                await call(comm, "create_message", room=room_id, message=f"mixed:{i}")
+                await call(comm, "join_room", pk=room_id)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client(room_id, comm) for room_id, comm in clients))
+        elapsed = time.perf_counter() - started
+        total = sum(len(samples) for samples in latencies.values())
+        return {
+            "clients": len(clients),
+            "operations": total,
+            "seconds": round(elapsed, 3),
+            "operations_per_sec": round(total / elapsed, 1) if elapsed else None,
+            **{action: _percentiles(samples) for action, samples in latencies.items()},
+        }
+
+    async def _run_writes(self, clients, per_client, timeout):
+        """
+        create_message throughput with every client sending `per_client`
+        messages and waiting for each ack: first on the direct path (one
+        insert per hop), then through the write-behind MessageWriter.
+        """
+        from chat import persistence
+
+        async def client(room_id, comm, latencies):
+            for i in range(per_client):
+                started = time.perf_counter()
+                await comm.send_json_to({"action": "create_message", "request_id": "write",
+                                         "room": room_id, "message": f"write:{i}"})
+                while True:
+                    frame = await comm.receive_json_from(timeout=timeout)
+                    if frame.get("action") == "create_message" and "response_status" in frame:
+                        break
+                latencies.append(time.perf_counter() - started)
+
+        results = {}
+        saved = persistence.WRITE_BEHIND
+        try:
+            for name, write_behind in (("direct", False), ("write_behind", True)):
+                persistence.WRITE_BEHIND = write_behind
+                latencies = []
+                started = time.perf_counter()
+                await asyncio.gather(*(client(room_id, comm, latencies) for room_id, comm in clients))
+                elapsed = time.perf_counter() - started
+                results[name] = {
+                    "messages": len(latencies),
+                    "seconds": round(elapsed, 3),
+                    "messages_per_sec": round(len(latencies) / elapsed, 1) if elapsed else None,
+                    "ack_latency": _percentiles(latencies),
+                }
+        finally:
+            persistence.WRITE_BEHIND = saved
+        return results
+
+    async def _run_handshakes(self, rooms, open_socket, gate):
+        """
+        Connect and immediately close one chat socket per session, twice:
+        the first round resolves every session from the database, the second
+        is what a reconnect storm looks like once the auth cache is warm.
+        """
+        keys = [key for _, room_keys in rooms for key in room_keys]
+        results = {}
+        for name in ("cold", "warm"):
+            latencies = []
+
+            async def handshake(session_key):
+                async with gate:
+                    started = time.perf_counter()
+                    comm = await open_socket("/ws/chat/room/", session_key)
+                    latencies.append(time.perf_counter() - started)
+                    await comm.disconnect()
+
+            started = time.perf_counter()
+            await asyncio.gather(*(handshake(key) for key in keys))
+            elapsed = time.perf_counter() - started
+            results[name] = {
+                "handshakes": len(latencies),
+                "seconds": round(elapsed, 3),
+                "handshakes_per_sec": round(len(latencies) / elapsed, 1) if elapsed else None,
+                "latency": _percentiles(latencies),
+            }
+        return results
+
+    async def _run_presence(self, rooms, open_socket, gate, timeout):
+        results = {}
+        endpoints = {
+            "global": lambda room_id: "/ws/presence/",
+            "room": lambda room_id: f"/ws/room/{room_id}/presence/",
+        }
+        for name, path_for in endpoints.items():
+            latencies = []
+
+            async def connect(room_id, session_key):
+                async with gate:
+                    started = time.perf_counter()
+                    comm = await open_socket(path_for(room_id), session_key)
+                    await comm.receive_json_from(timeout=timeout)
+                    latencies.append(time.perf_counter() - started)
+                    return comm
+
+            started = time.perf_counter()
+            try:
+                sockets = await asyncio.gather(*(connect(room_id, key) for room_id, keys in rooms for key in keys))
+            except Exception as exc:
+                results[name] = {"error": repr(exc)}
+                continue
+            elapsed = time.perf_counter() - started
+            await asyncio.gather(*(comm.disconnect() for comm in sockets))
+            results[name] = {
+                "clients": len(sockets),
+                "connect_seconds": round(elapsed, 3),
+                "connect_latency": _percentiles(latencies),
+            }
+        return results
+
+    async def _run_presence_storm(self, rooms, open_socket, gate, timeout, window=None):
+        """
+        Presence frames delivered while every client opens /ws/presence/ at
+        once (connect storm), then while every other client drops and
+        reopens its socket and the rest stay connected (reconnect storm).
+        Batching keeps the first near clients x windows rather than
+        clients^2 / 2; debouncing keeps the second near zero. `window`
+        overrides the broadcast window for the round; 0 announces every
+        transition on its own.
+        """
+        from chat.presence import broadcaster
+
+        configured = broadcaster.interval
+        if window is not None:
+            broadcaster.interval = window
+        try:
+            return await self._presence_storm(rooms, open_socket, gate, timeout, broadcaster.interval)
+        finally:
+            broadcaster.interval = configured
+
+    async def _presence_storm(self, rooms, open_socket, gate, timeout, window):
+        # Quiet long enough for the last window to be flushed and delivered.
+        settle = window * 2 + 0.5
+
+        async def connect(session_key):
+            async with gate:
+                comm = await open_socket("/ws/presence/", session_key)
+                await comm.receive_json_from(timeout=timeout)  # all_online
+                return comm
+
+        async def count_frames(comm):
+            frames = 0
+            while not await comm.receive_nothing(timeout=settle):
+                await comm.receive_json_from(timeout=timeout)
+                frames += 1
+            return frames
+
+        keys = [key for _, room_keys in rooms for key in room_keys]
+        try:
+            sockets = await asyncio.gather(*(connect(key) for key in keys))
+        except Exception as exc:
+            return {"error": repr(exc)}
+        connect_frames = sum(await asyncio.gather(*(count_frames(comm) for comm in sockets)))
+
+        observers, churned = sockets[::2], list(zip(keys[1::2], sockets[1::2]))
+
+        async def reconnect(session_key, comm):
+            await comm.disconnect()
+            return await connect(session_key)
+
+        reconnected = await asyncio.gather(*(reconnect(key, comm) for key, comm in churned))
+        reconnect_frames = sum(await asyncio.gather(*(count_frames(comm) for comm in observers)))
+        await asyncio.gather(*(comm.disconnect() for comm in observers + reconnected))
+        # Let the offline announcements go out before the next round connects.
+        await asyncio.sleep(settle)
+        return {
+            "window_seconds": window,
+            "connect": {"clients": len(sockets), "frames": connect_frames,
+                        "frames_per_client": round(connect_frames / len(sockets), 2) if sockets else None},
+            "reconnect": {"reconnected": len(churned), "observers": len(observers), "frames": reconnect_frames},
+        }
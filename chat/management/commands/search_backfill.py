@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import Message
+from chat.search import get_backend
+
+
+class Command(BaseCommand):
+    help = "Index existing messages for full-text search, in id-ordered chunks."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument("--room", type=int, help="only index this room")
+        parser.add_argument("--after-id", type=int, default=0, help="resume after this message id")
+
+    def handle(self, *args, **opts):
+        backend = get_backend()
+        qs = Message.objects.order_by("pk").only("pk", "room_id", "text")
+        if opts["room"]:
+            qs = qs.filter(room_id=opts["room"])
+
+        last_id, total = opts["after_id"], 0
+        while True:
+            chunk = list(qs.filter(pk__gt=last_id)[:opts["chunk_size"]])
+            if not chunk:
+                break
+            backend.index_messages(chunk)
+            last_id = chunk[-1].pk
+            total += len(chunk)
+            self.stdout.write(f"indexed {total} messages (last id {last_id})")
+        self.stdout.write(self.style.SUCCESS(f"Done: {total} messages indexed."))
@@ -0,0 +1,30 @@
+import asyncio
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.presence import SWEEP_BATCH_SIZE, PresenceSweeper
+
+
+class Command(BaseCommand):
+    help = "Remove expired members from the presence sets and send the matching offline / room_leave events."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=SWEEP_BATCH_SIZE,
+                            help="SCAN/ZSCAN count and members removed per round trip")
+        parser.add_argument("--every", type=float, default=0,
+                            help="keep running, sweeping every N seconds")
+
+    def handle(self, *args, **opts):
+        sweeper = PresenceSweeper(interval=0, batch_size=opts["batch_size"])
+        while True:
+            started = time.perf_counter()
+            stats = asyncio.run(sweeper.sweep())
+            elapsed = time.perf_counter() - started
+            self.stdout.write(self.style.SUCCESS(
+                f"Swept {stats['offline']} offline users and {stats['room_members']} room members "
+                f"from {stats['room_keys_pruned']} of {stats['room_keys']} room keys in {elapsed:.2f}s."
+            ))
+            if not opts["every"]:
+                break
+            time.sleep(opts["every"])
@@ -0,0 +1,137 @@
+import functools
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Tuple
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+
+from . import executor
+
+# With CHAT_METRICS_ENABLED = False the decorators below return the
+# wrapped function untouched and the helpers skip timing entirely.
+ENABLED = getattr(settings, "CHAT_METRICS_ENABLED", True)
+BUCKETS = getattr(settings, "CHAT_METRICS_BUCKETS", (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+))
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense, per process."""
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+_histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Histogram] = {}
+
+
+def histogram(name: str, **labels) -> Histogram:
+    key = (name, tuple(sorted(labels.items())))
+    hist = _histograms.get(key)
+    if hist is None:
+        hist = _histograms[key] = Histogram()
+    return hist
+
+
+def observe(name: str, seconds: float, **labels) -> None:
+    if ENABLED:
+        histogram(name, **labels).observe(seconds)
+
+
+@contextmanager
+def timed(name: str, **labels):
+    if not ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram(name, **labels).observe(time.perf_counter() - started)
+
+
+def instrument(name: str, **labels):
+    """Decorator timing every call of a sync or async function."""
+    def decorator(func):
+        if not ENABLED:
+            return func
+        hist = histogram(name, **labels)
+
+        if iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    hist.observe(time.perf_counter() - started)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                hist.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def db_hop(func, call: str, write: bool = False):
+    """
+    func on the database executor (writer lane when `write`), timed as
+    chat_db_hop_seconds{call=...}.
+    """
+    return instrument("chat_db_hop_seconds", call=call)(executor.database_hop(func, write))
+
+
+def thread_hop(func, call: str):
+    """sync_to_async(func), timed as chat_thread_hop_seconds{call=...}."""
+    return instrument("chat_thread_hop_seconds", call=call)(sync_to_async(func))
+
+
+async def group_send(channel_layer, group: str, message: dict, kind: str) -> None:
+    with timed("chat_group_send_seconds", kind=kind):
+        await channel_layer.group_send(group, message)
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in pairs)
+
+
+def render() -> str:
+    """Prometheus text exposition of every histogram and the throttle counters."""
+    from . import throttling
+
+    lines = []
+    seen = set()
+    for (name, labels), hist in sorted(_histograms.items()):
+        if name not in seen:
+            lines.append(f"# TYPE {name} histogram")
+            seen.add(name)
+        cumulative = 0
+        for bound, n in zip(BUCKETS, hist.counts):
+            cumulative += n
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {hist.count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {hist.total}")
+        lines.append(f"{name}_count{_format_labels(labels)} {hist.count}")
+
+    lines.append("# TYPE chat_events_total counter")
+    for event, n in sorted(throttling.counters.items()):
+        lines.append(f'chat_events_total{{event="{event}"}} {n}')
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.7 on 2026-10-18 13:36
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def backfill_unread_count(apps, schema_editor):
+    RoomMembership = apps.get_model("chat", "RoomMembership")
+    Message = apps.get_model("chat", "Message")
+    newer = (Message.objects.filter(room=models.OuterRef("room"), created_at__gt=models.OuterRef("last_seen"))
+             .exclude(user=models.OuterRef("user")).order_by().values("room")
+             .annotate(n=models.Count("pk")).values("n"))
+    RoomMembership.objects.update(unread_count=Coalesce(models.Subquery(newer), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_archived_segment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='roommembership',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_unread_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+from django.db import migrations
+
+
+def set_journal_mode(mode):
+    def apply(apps, schema_editor):
+        # journal_mode=WAL is stored in the database file, so it is set once
+        # here rather than by every connection's init_command.
+        if schema_editor.connection.vendor == "sqlite":
+            schema_editor.execute(f"PRAGMA journal_mode={mode}")
+    return apply
+
+
+class Migration(migrations.Migration):
+    # SQLite cannot change the journal mode inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('chat', '0006_membership_unread_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(set_journal_mode("WAL"), set_journal_mode("DELETE")),
+    ]
@@ -1,29 +1,49 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import AbstractUser
 from django.utils import timezone
 
 class User(AbstractUser):
     pass
 
+class RoomQuerySet(models.QuerySet):
+    def with_snapshot(self):
+        """Load everything RoomSerializer reads in a fixed number of queries."""
+        return self.select_related("last_message__user").prefetch_related(
+            models.Prefetch("memberships", queryset=RoomMembership.objects.select_related("user"))
+        )
+
 class Room(models.Model):
     name = models.CharField(max_length=255, unique=True)
     current_users = models.ManyToManyField("User", related_name="current_rooms", blank=True, through="RoomMembership")
+    # Maintained by Message.save()/delete() so readers never have to sort the messages table;
+    # queryset deletes are repaired by chat.signals.repair_last_message.
+    last_message = models.ForeignKey("Message", null=True, blank=True, on_delete=models.SET_NULL, related_name="+")
+
+    objects = RoomQuerySet.as_manager()
 
     def __str__(self):
         return f"Room({self.name})"
 
+    def refresh_last_message(self):
+        self.last_message = self.messages.order_by("created_at", "id").last()
+        self.save(update_fields=["last_message"])
+
 class RoomMembership(models.Model):
     room = models.ForeignKey("Room", on_delete=models.CASCADE, related_name="memberships")
     user = models.ForeignKey("User", on_delete=models.CASCADE, related_name="memberships")
     nickname = models.CharField(max_length=50, blank=True)
     last_seen = models.DateTimeField(default=timezone.now)
+    # Messages from others since last_seen; bumped by Message.save() and
+    # recomputed whenever last_seen moves (see history.save_read_positions_many).
+    unread_count = models.PositiveIntegerField(default=0)
 
     class Meta:
         unique_together = ("room", "user")
 
     def touch(self):
         self.last_seen = timezone.now()
-        self.save(update_fields=["last_seen"])
+        self.unread_count = 0
+        self.save(update_fields=["last_seen", "unread_count"])
 
 class Message(models.Model):
     room = models.ForeignKey("Room", on_delete=models.CASCADE, related_name="messages")
@@ -31,5 +51,58 @@ class Message(models.Model):
     text = models.TextField(max_length=500)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["room", "created_at", "id"], name="chat_msg_room_created_id_idx"),
+        ]
+
     def __str__(self):
         return f"Message({self.user} -> {self.room})"
+
+    def save(self, *args, **kwargs):
+        creating = self._state.adding
+        with transaction.atomic(savepoint=False):
+            super().save(*args, **kwargs)
+            if creating:
+                Room.objects.filter(pk=self.room_id).filter(
+                    models.Q(last_message__isnull=True) | models.Q(last_message__lt=self.pk)
+                ).update(last_message=self)
+                RoomMembership.objects.filter(room_id=self.room_id).exclude(user_id=self.user_id).update(
+                    unread_count=models.F("unread_count") + 1
+                )
+
+    def delete(self, *args, **kwargs):
+        # Not wrapped in atomic(): the delete collector opens its own block,
+        # and nesting it trips the observer's savepoint warning.
+        was_last = Room.objects.filter(pk=self.room_id, last_message=self.pk).exists()
+        RoomMembership.objects.filter(
+            room_id=self.room_id, last_seen__lt=self.created_at, unread_count__gt=0
+        ).exclude(user_id=self.user_id).update(unread_count=models.F("unread_count") - 1)
+        result = super().delete(*args, **kwargs)
+        if was_last:
+            Room.objects.get(pk=self.room_id).refresh_last_message()
+        return result
+
+class ArchivedSegment(models.Model):
+    """
+    A run of old messages of one room moved out of the hot table by
+    chat.archive, stored as compressed JSON rows in (created_at, id) order.
+    Segments of a room are append-only and numbered by seq.
+    """
+    room = models.ForeignKey("Room", on_delete=models.CASCADE, related_name="archived_segments")
+    seq = models.PositiveIntegerField()
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    first_created_at = models.DateTimeField()
+    last_created_at = models.DateTimeField()
+    count = models.PositiveIntegerField()
+    data = models.BinaryField()
+
+    class Meta:
+        unique_together = ("room", "seq")
+        indexes = [
+            models.Index(fields=["room", "first_id", "last_id"], name="chat_segment_id_range_idx"),
+        ]
+
+    def __str__(self):
+        return f"ArchivedSegment({self.room_id}#{self.seq}: {self.first_id}..{self.last_id})"
@@ -0,0 +1,116 @@
+import asyncio
+from collections import Counter
+from typing import Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import router, transaction
+from django.db.models import F, Q
+from django.db.models.signals import post_save
+
+from . import metrics
+from .models import Message, Room, RoomMembership
+
+WRITE_BEHIND = getattr(settings, "CHAT_MESSAGE_WRITE_BEHIND", False)
+BATCH_SIZE = getattr(settings, "CHAT_MESSAGE_BATCH_SIZE", 100)
+BATCH_SECONDS = getattr(settings, "CHAT_MESSAGE_BATCH_SECONDS", 0.02)
+
+
+def bulk_create_messages(entries: Iterable[Tuple[int, object, str]]) -> List[Optional[Message]]:
+    """
+    Persist (room_id, user, text) entries in one transaction.
+
+    Returns one item per entry: the created Message, or None when its room
+    does not exist. bulk_create() skips model signals, so post_save is sent
+    by hand (in insertion order) for the message_activity observer, and
+    Room.last_message and the unread counters are moved once per room.
+    """
+    entries = list(entries)
+    room_ids = {room_id for room_id, _, _ in entries}
+    with transaction.atomic():
+        existing = set(Room.objects.filter(pk__in=room_ids).values_list("pk", flat=True))
+        results = [
+            Message(room_id=room_id, user=user, text=text) if room_id in existing else None
+            for room_id, user, text in entries
+        ]
+        created = Message.objects.bulk_create([m for m in results if m is not None])
+
+        latest = {}
+        for msg in created:
+            latest[msg.room_id] = msg.pk
+        for room_id, pk in latest.items():
+            Room.objects.filter(pk=room_id).filter(
+                Q(last_message__isnull=True) | Q(last_message__lt=pk)
+            ).update(last_message=pk)
+
+        # Unread counters: +n for every member of the room, minus each
+        # author's own messages, in two UPDATEs per room instead of n.
+        for room_id, count in Counter(msg.room_id for msg in created).items():
+            RoomMembership.objects.filter(room_id=room_id).update(unread_count=F("unread_count") + count)
+        for (room_id, user_id), count in Counter((msg.room_id, msg.user_id) for msg in created).items():
+            RoomMembership.objects.filter(room_id=room_id, user_id=user_id).update(
+                unread_count=F("unread_count") - count
+            )
+
+        using = router.db_for_write(Message)
+        for msg in created:
+            post_save.send(sender=Message, instance=msg, created=True,
+                           update_fields=None, raw=False, using=using)
+    return results
+
+
+class MessageWriter:
+    """
+    Write-behind queue for create_message.
+
+    Messages are collected until BATCH_SIZE are waiting or BATCH_SECONDS
+    have passed since the first one, then written with bulk_create_messages
+    in a single database hop. submit() resolves only after that batch has
+    committed.
+    """
+    def __init__(self, batch_size: int = BATCH_SIZE, batch_seconds: float = BATCH_SECONDS):
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self._queue = None
+        self._task = None
+
+    async def submit(self, room_id: int, user, text: str) -> Optional[Message]:
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._run())
+        future = loop.create_future()
+        self._queue.put_nowait((room_id, user, text, future))
+        return await future
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.batch_seconds
+        while len(batch) < self.batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                results = await metrics.db_hop(bulk_create_messages, "bulk_create_messages", write=True)(
+                    (room_id, user, text) for room_id, user, text, _ in batch
+                )
+            except Exception as exc:
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+            for (*_, future), msg in zip(batch, results):
+                if not future.done():
+                    future.set_result(msg)
+
+
+message_writer = MessageWriter()
@@ -1,12 +1,34 @@
-from typing import List, Set
+import asyncio
+import logging
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from channels.layers import get_channel_layer
 from django.conf import settings
-from django.core.cache import cache
-from django.core.cache.backends.redis import RedisCache
+
+from . import audience, metrics
+from .batching import WindowedBatch
+from .redis_client import redis_client
+
+logger = logging.getLogger(__name__)
 
 TTL = getattr(settings, "PRESENCE_TTL_SECONDS", 60)
+# Buffered heartbeats may land this late, so keep it a small slice of the TTL.
+HEARTBEAT_FLUSH_SECONDS = getattr(settings, "PRESENCE_HEARTBEAT_FLUSH_SECONDS", max(1, TTL // 12))
+# 0 announces every transition on its own, without batching or debouncing.
+BROADCAST_WINDOW_SECONDS = getattr(settings, "PRESENCE_BROADCAST_WINDOW_SECONDS", 1)
+# 0 disables the in-process sweeper; run `manage.py sweep_presence` instead.
+SWEEP_INTERVAL_SECONDS = getattr(settings, "PRESENCE_SWEEP_INTERVAL_SECONDS", TTL)
+SWEEP_BATCH_SIZE = getattr(settings, "PRESENCE_SWEEP_BATCH_SIZE", 500)
 
-def _user_ttl_key(user_id: int) -> str:
-    return f"presence:user:{user_id}"  
+# Liveness is stored as sorted sets:
+#   presence:global:users      member=user_id, score=expiry timestamp
+#   presence:room:{id}:users   member=user_id, score=join timestamp
+# so "who is online" is a single round trip no matter how many members a
+# set holds. Readers only filter expired members out; removing them (and
+# telling the clients) is left to PresenceSweeper. Every write that adds
+# or removes a member also bumps the set's version counter
+#   presence:global:version, presence:room:{id}:version
+# which keys the cached HTTP snapshots (chat.snapshots).
 
 def _global_set_key() -> str:
     return "presence:global:users"
@@ -14,61 +36,358 @@ def _global_set_key() -> str:
 def _room_set_key(room_id: int) -> str:
     return f"presence:room:{room_id}:users"
 
-def _client():
-    try:
-        return cache.client.get_client()
-    except AttributeError:
-        raise RuntimeError("Presence requires RedisCache backend.")
+_ROOM_SET_PATTERN = "presence:room:*:users"
 
+def _global_version_key() -> str:
+    return "presence:global:version"
 
-def sadd(key: str, member):
-    _client().sadd(key, member)
+def _room_version_key(room_id: int) -> str:
+    return f"presence:room:{room_id}:version"
 
-def srem(key: str, member):
-    _client().srem(key, member)
+def version_keys(room_id: Optional[int] = None) -> List[str]:
+    """The version counters an online snapshot depends on: global, plus the room's."""
+    if room_id is None:
+        return [_global_version_key()]
+    return [_global_version_key(), _room_version_key(room_id)]
 
-def smembers(key: str):
-    return _client().smembers(key)
+def room_group_name(room_id: int) -> str:
+    return f"presence_room_{room_id}"
 
-def heartbeat(user_id: int) -> None:
-    cache.set(_user_ttl_key(user_id), "1", TTL)
-    sadd(_global_set_key(), user_id)
+def user_group_name(user_id: int) -> str:
+    """Every presence socket of a user; scoped presence events are sent here."""
+    return f"presence_user_{user_id}"
 
-def remove_global(user_id: int) -> None:
-    cache.delete(_user_ttl_key(user_id))
-    srem(_global_set_key(), user_id)
 
-def list_online_user_ids() -> List[int]:
-    raw = smembers(_global_set_key())
-    alive: List[int] = []
+def _to_ids(raw: Iterable) -> List[int]:
+    ids: List[int] = []
     for uid_raw in raw:
         try:
-            uid = int(uid_raw)
+            ids.append(int(uid_raw))
         except Exception:
-            uid = uid_raw
-        if cache.get(_user_ttl_key(uid)) is not None:
-            alive.append(uid)
-        else:
-            srem(_global_set_key(), uid) 
-    return alive
+            ids.append(uid_raw)
+    return ids
+
+def _bump(client, changes: Dict[str, int]) -> None:
+    """INCR the version keys whose set gained or lost members; {version key: change count}."""
+    changed = [key for key, count in changes.items() if count]
+    if len(changed) == 1:
+        client.incr(changed[0])
+    elif changed:
+        pipe = client.pipeline(transaction=False)
+        for key in changed:
+            pipe.incr(key)
+        pipe.execute()
+
+# Sets each user's expiry and bumps the version when one of them was not
+# online before: missing, or expired but not swept yet (ZADD alone counts
+# those as updates, not additions).
+_REFRESH_GLOBAL = """
+local now = tonumber(ARGV[1])
+local revived = 0
+for i = 3, #ARGV do
+  local expires = redis.call('ZSCORE', KEYS[1], ARGV[i])
+  if not expires or tonumber(expires) <= now then revived = revived + 1 end
+  redis.call('ZADD', KEYS[1], ARGV[2], ARGV[i])
+end
+if revived > 0 then redis.call('INCR', KEYS[2]) end
+return revived
+"""
+
+def _refresh_global(client, user_ids: Iterable[int], now: float) -> int:
+    script = client.register_script(_REFRESH_GLOBAL)
+    return script(keys=[_global_set_key(), _global_version_key()], args=[now, now + TTL, *user_ids], client=client)
+
+@metrics.instrument("chat_presence_seconds", op="heartbeat")
+def heartbeat(user_id: int) -> None:
+    _refresh_global(redis_client(), [user_id], time.time())
+
+@metrics.instrument("chat_presence_seconds", op="heartbeat_many")
+def heartbeat_many(user_ids: Iterable[int]) -> None:
+    user_ids = list(user_ids)
+    if user_ids:
+        # Refreshing users already online is the common case and costs no INCR.
+        _refresh_global(redis_client(), user_ids, time.time())
+
+@metrics.instrument("chat_presence_seconds", op="remove_global")
+def remove_global(user_id: int) -> None:
+    client = redis_client()
+    _bump(client, {_global_version_key(): client.zrem(_global_set_key(), user_id)})
 
+@metrics.instrument("chat_presence_seconds", op="list_online_user_ids")
+def list_online_user_ids() -> List[int]:
+    return _to_ids(redis_client().zrangebyscore(_global_set_key(), f"({time.time()}", "+inf"))
+
+@metrics.instrument("chat_presence_seconds", op="online_among")
+def online_among(user_ids: Iterable[int]) -> List[int]:
+    """The subset of `user_ids` that is online, in one ZMSCORE."""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return []
+    now = time.time()
+    expiries = redis_client().zmscore(_global_set_key(), user_ids)
+    return [uid for uid, expires in zip(user_ids, expiries) if expires is not None and expires > now]
+
+@metrics.instrument("chat_presence_seconds", op="interested_online_user_ids")
+def interested_online_user_ids(user_id: int) -> List[int]:
+    """Online users among those `user_id` shares a room with or watches."""
+    return online_among(audience.interest(user_id))
+
+@metrics.instrument("chat_presence_seconds", op="presence_recipients")
+def presence_recipients(online: List[int], offline: List[int]) -> Dict[int, Dict[str, List[int]]]:
+    """
+    {recipient: {"online": [...], "offline": [...]}} for a set of
+    transitions: each changed user goes to the online part of its audience.
+    """
+    audiences = audience.audiences(online + offline)
+    live = set(online_among(set().union(*audiences.values())))
+    batches: Dict[int, Dict[str, List[int]]] = {}
+    for state, user_ids in (("online", online), ("offline", offline)):
+        for uid in user_ids:
+            for recipient in audiences[uid] & live:
+                batches.setdefault(recipient, {"online": [], "offline": []})[state].append(uid)
+    return batches
+
+
+async def announce(online: List[int], offline: List[int], kind: str) -> None:
+    """Send presence transitions as one presence.batch per interested, online user."""
+    if not online and not offline:
+        return
+    batches = await metrics.db_hop(presence_recipients, "presence_recipients")(online, offline)
+    layer = get_channel_layer()
+    await asyncio.gather(*(
+        metrics.group_send(layer, user_group_name(recipient), {"type": "presence.batch", **batch}, kind=kind)
+        for recipient, batch in batches.items()
+    ))
+
+
+@metrics.instrument("chat_presence_seconds", op="room_join")
 def room_join(user_id: int, room_id: int) -> None:
-    sadd(_room_set_key(room_id), user_id)
-    heartbeat(user_id)
+    now = time.time()
+    client = redis_client()
+    _bump(client, {_room_version_key(room_id): client.zadd(_room_set_key(room_id), {user_id: now})})
+    _refresh_global(client, [user_id], now)
 
+@metrics.instrument("chat_presence_seconds", op="room_leave")
 def room_leave(user_id: int, room_id: int) -> None:
-    srem(_room_set_key(room_id), user_id)
+    client = redis_client()
+    _bump(client, {_room_version_key(room_id): client.zrem(_room_set_key(room_id), user_id)})
 
+@metrics.instrument("chat_presence_seconds", op="room_online_user_ids")
 def room_online_user_ids(room_id: int) -> List[int]:
-    raw = smembers(_room_set_key(room_id))
-    alive: List[int] = []
-    for uid_raw in raw:
-        try:
-            uid = int(uid_raw)
-        except Exception:
-            uid = uid_raw
-        if cache.get(_user_ttl_key(uid)) is not None:
-            alive.append(uid)
+    # Weight 0 on the room side leaves each member's global expiry as its score.
+    members = redis_client().zinter({_room_set_key(room_id): 0, _global_set_key(): 1}, withscores=True)
+    now = time.time()
+    return _to_ids(uid for uid, expires in members if expires > now)
+
+
+@metrics.instrument("chat_presence_seconds", op="online_snapshot_source")
+def online_snapshot_source(room_id: Optional[int] = None) -> Tuple[Tuple[int, ...], Dict[int, float]]:
+    """
+    (versions, {user_id: expiry}) of the online users, globally or of one
+    room, read in a single MULTI so the versions match the members exactly.
+    A room depends on the global set too, so its versions are (global, room).
+    """
+    pipe = redis_client().pipeline(transaction=True)
+    pipe.get(_global_version_key())
+    if room_id is None:
+        pipe.zrangebyscore(_global_set_key(), f"({time.time()}", "+inf", withscores=True)
+        global_version, members = pipe.execute()
+        versions = (int(global_version or 0),)
+    else:
+        pipe.get(_room_version_key(room_id))
+        pipe.zinter({_room_set_key(room_id): 0, _global_set_key(): 1}, withscores=True)
+        global_version, room_version, members = pipe.execute()
+        versions = (int(global_version or 0), int(room_version or 0))
+    now = time.time()
+    return versions, {int(uid): expires for uid, expires in members if expires > now}
+
+
+# Both scripts check and remove in one step, so a member that heartbeats
+# or rejoins mid-sweep is never dropped, and concurrent sweepers (one per
+# process) never report the same member twice.
+
+_EXPIRE_GLOBAL = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #ids > 0 then
+  redis.call('ZREM', KEYS[1], unpack(ids))
+  redis.call('INCR', KEYS[2])
+end
+return ids
+"""
+
+_PRUNE_ROOM = """
+local gone = {}
+for i = 2, #ARGV do
+  local expires = redis.call('ZSCORE', KEYS[2], ARGV[i])
+  if not expires or tonumber(expires) <= tonumber(ARGV[1]) then
+    if redis.call('ZREM', KEYS[1], ARGV[i]) == 1 then table.insert(gone, ARGV[i]) end
+  end
+end
+if #gone > 0 then redis.call('INCR', KEYS[3]) end
+return gone
+"""
+
+@metrics.instrument("chat_presence_seconds", op="expire_global")
+def expire_global(limit: int) -> List[int]:
+    """Remove up to `limit` expired users from the global set and return them."""
+    script = redis_client().register_script(_EXPIRE_GLOBAL)
+    return _to_ids(script(keys=[_global_set_key(), _global_version_key()], args=[time.time(), limit]))
+
+@metrics.instrument("chat_presence_seconds", op="sweep_rooms")
+def sweep_rooms(cursor: int, batch_size: int) -> Tuple[int, int, Dict[int, List[int]]]:
+    """
+    One SCAN step over the room sets: drops members that are no longer in
+    the live global set, ZSCANning each room `batch_size` members at a time.
+    Returns (next cursor, keys scanned, {room_id: removed user ids}).
+    """
+    client = redis_client()
+    script = client.register_script(_PRUNE_ROOM)
+    cursor, keys = client.scan(cursor, match=_ROOM_SET_PATTERN, count=batch_size)
+    removed: Dict[int, List[int]] = {}
+    for key in keys:
+        key = key.decode() if isinstance(key, bytes) else key
+        room_id = int(key.split(":")[2])
+        member_cursor = 0
+        while True:
+            member_cursor, members = client.zscan(key, member_cursor, count=batch_size)
+            if members:
+                gone = script(keys=[key, _global_set_key(), _room_version_key(room_id)],
+                              args=[time.time(), *(m for m, _ in members)])
+                if gone:
+                    removed.setdefault(room_id, []).extend(_to_ids(gone))
+            if not member_cursor:
+                break
+    return cursor, len(keys), removed
+
+
+class HeartbeatBatcher(WindowedBatch):
+    """
+    Collects user ids that heartbeated during a window and writes them
+    with a single ZADD. Several tabs of one user collapse into one entry.
+    """
+    def __init__(self, interval: float = HEARTBEAT_FLUSH_SECONDS):
+        super().__init__(interval)
+        self._pending: Set[int] = set()
+
+    def add(self, user_id: int) -> None:
+        self._pending.add(user_id)
+        self._schedule()
+
+    def _has_pending(self) -> bool:
+        return bool(self._pending)
+
+    async def flush(self) -> None:
+        ids, self._pending = self._pending, set()
+        if ids:
+            await metrics.thread_hop(heartbeat_many, "heartbeat_many")(ids)
+
+
+class PresenceBroadcaster(WindowedBatch):
+    """
+    Collects online/offline transitions during a window and announces
+    them: each interested user gets one presence.batch event covering the
+    window. A user who ends the window in the state they started it in
+    (e.g. a quick reconnect) is left out. With an interval of 0 every
+    transition is announced on its own, in order.
+    """
+    def __init__(self, interval: float = BROADCAST_WINDOW_SECONDS):
+        super().__init__(interval)
+        self._initial: Dict[int, bool] = {}
+        self._current: Dict[int, bool] = {}
+        self._transitions: List[Tuple[int, bool]] = []
+
+    def online(self, user_id: int) -> None:
+        self._mark(user_id, True)
+
+    def offline(self, user_id: int) -> None:
+        self._mark(user_id, False)
+
+    def _mark(self, user_id: int, is_online: bool) -> None:
+        if self.interval:
+            self._initial.setdefault(user_id, not is_online)
+            self._current[user_id] = is_online
         else:
-            srem(_room_set_key(room_id), uid)
-    return alive
+            self._transitions.append((user_id, is_online))
+        self._schedule()
+
+    def _has_pending(self) -> bool:
+        return bool(self._current or self._transitions)
+
+    async def flush(self) -> None:
+        transitions, self._transitions = self._transitions, []
+        for user_id, is_online in transitions:
+            await announce([user_id] if is_online else [], [] if is_online else [user_id], kind="presence_batch")
+        initial, current = self._initial, self._current
+        self._initial, self._current = {}, {}
+        if not current:
+            return
+        online = [uid for uid, state in current.items() if state and not initial[uid]]
+        offline = [uid for uid, state in current.items() if not state and initial[uid]]
+        await announce(online, offline, kind="presence_batch")
+
+
+class PresenceSweeper:
+    """
+    Removes expired members from the global and room presence sets in
+    bounded batches and announces them: offline to each user's audience
+    and a room_leave presence.update per room member, the same events a
+    clean disconnect sends. Covers sockets whose process died before
+    disconnect() could run.
+
+    Runs every `interval` seconds in-process, started by the first
+    presence connection when PRESENCE_SWEEP_INTERVAL_SECONDS is set, or
+    from `manage.py sweep_presence`.
+    """
+    def __init__(self, interval: float = SWEEP_INTERVAL_SECONDS, batch_size: int = SWEEP_BATCH_SIZE):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._task = None
+
+    def ensure_started(self) -> None:
+        if self.interval and (self._task is None or self._task.done()):
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    @metrics.instrument("chat_presence_seconds", op="sweep")
+    async def sweep(self) -> Dict[str, int]:
+        """One full pass; returns counts of what was swept."""
+        layer = get_channel_layer()
+        stats = {"offline": 0, "room_members": 0, "room_keys": 0, "room_keys_pruned": 0}
+        while True:
+            ids = await metrics.thread_hop(expire_global, "expire_global")(self.batch_size)
+            stats["offline"] += len(ids)
+            await announce([], ids, kind="presence_sweep")
+            if len(ids) < self.batch_size:
+                break
+
+        cursor = 0
+        while True:
+            cursor, scanned, removed = await metrics.thread_hop(sweep_rooms, "sweep_rooms")(cursor, self.batch_size)
+            stats["room_keys"] += scanned
+            stats["room_keys_pruned"] += len(removed)
+            for room_id, user_ids in removed.items():
+                stats["room_members"] += len(user_ids)
+                for user_id in user_ids:
+                    await metrics.group_send(layer, room_group_name(room_id), {
+                        "type": "presence.update",
+                        "payload": {"event": "room_leave", "user_id": user_id, "room_id": room_id},
+                    }, kind="presence_sweep")
+            if not cursor:
+                break
+        return stats
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                stats = await self.sweep()
+            except Exception:
+                logger.exception("Presence sweep failed")
+                continue
+            if stats["offline"] or stats["room_members"]:
+                logger.info("Presence sweep: %d offline, %d room members from %d of %d room keys",
+                            stats["offline"], stats["room_members"], stats["room_keys_pruned"], stats["room_keys"])
+
+
+heartbeat_batcher = HeartbeatBatcher()
+broadcaster = PresenceBroadcaster()
+sweeper = PresenceSweeper()
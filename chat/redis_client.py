@@ -0,0 +1,9 @@
+from django.core.cache import cache
+
+
+def redis_client():
+    """The redis-py client behind the default cache; presence, buffers and the other Redis-backed parts share it."""
+    try:
+        return cache.client.get_client()
+    except AttributeError:
+        raise RuntimeError("This feature requires the django_redis RedisCache backend as the default cache.")
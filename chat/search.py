@@ -0,0 +1,150 @@
+import re
+from functools import lru_cache
+from typing import Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+from .models import Message
+
+PAGE_SIZE = getattr(settings, "CHAT_SEARCH_PAGE_SIZE", 20)
+MAX_PAGE_SIZE = getattr(settings, "CHAT_SEARCH_MAX_PAGE_SIZE", 100)
+
+_TERM = re.compile(r"\w+", re.UNICODE)
+
+
+def parse_cursor(cursor: Optional[str]) -> Optional[Tuple[float, int]]:
+    """Cursors are "<score>:<message id>" of the last hit on the previous page."""
+    if not cursor:
+        return None
+    try:
+        score, pk = str(cursor).rsplit(":", 1)
+        return float(score), int(pk)
+    except ValueError:
+        return None
+
+
+def format_cursor(score: float, pk: int) -> str:
+    return f"{score!r}:{pk}"
+
+
+class SearchBackend:
+    """
+    Full-text index over Message.text. Scores sort ascending (best first)
+    so every backend can share one (score, id) keyset cursor.
+    """
+    def index_messages(self, messages: Iterable[Message]) -> None:
+        raise NotImplementedError
+
+    def remove_messages(self, message_ids: Iterable[int]) -> None:
+        raise NotImplementedError
+
+    def search_ids(self, room_id: int, query: str, after: Optional[Tuple[float, int]], limit: int) -> List[Tuple[int, float]]:
+        """Return [(message id, score)] of the best matches after the cursor."""
+        raise NotImplementedError
+
+    def search(self, room_id: int, query: str, cursor: Optional[str] = None,
+               limit: int = PAGE_SIZE) -> Tuple[List[Tuple[Message, float]], Optional[str]]:
+        if not _TERM.search(query or ""):
+            return [], None
+        hits = self.search_ids(room_id, query, parse_cursor(cursor), limit + 1)
+        more = len(hits) > limit
+        hits = hits[:limit]
+        by_id = Message.objects.select_related("user").in_bulk([pk for pk, _ in hits])
+        results = [(by_id[pk], score) for pk, score in hits if pk in by_id]
+        next_cursor = format_cursor(hits[-1][1], hits[-1][0]) if more else None
+        return results, next_cursor
+
+
+class SQLiteFTSBackend(SearchBackend):
+    """FTS5 table chat_message_fts (rowid = message id), created by migration 0004."""
+    table = "chat_message_fts"
+
+    @staticmethod
+    def match_expression(query: str) -> str:
+        # Quote every term so user input can never be read as FTS5 syntax.
+        return " ".join('"%s"' % term for term in _TERM.findall(query))
+
+    def index_messages(self, messages):
+        rows = [(m.pk, m.text, m.room_id) for m in messages]
+        if not rows:
+            return
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT OR REPLACE INTO {self.table}(rowid, text, room_id) VALUES (%s, %s, %s)", rows)
+
+    def remove_messages(self, message_ids):
+        ids = [(pk,) for pk in message_ids]
+        if ids:
+            with connection.cursor() as cursor:
+                cursor.executemany(f"DELETE FROM {self.table} WHERE rowid = %s", ids)
+
+    def search_ids(self, room_id, query, after, limit):
+        sql = (
+            f"SELECT rowid, score FROM ("
+            f"  SELECT rowid, bm25({self.table}) AS score FROM {self.table}"
+            f"  WHERE {self.table} MATCH %s AND room_id = %s"
+            f") "
+        )
+        params = [self.match_expression(query), room_id]
+        if after is not None:
+            sql += "WHERE score > %s OR (score = %s AND rowid > %s) "
+            params += [after[0], after[0], after[1]]
+        sql += "ORDER BY score, rowid LIMIT %s"
+        params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [(int(pk), float(score)) for pk, score in cursor.fetchall()]
+
+
+class PostgresSearchBackend(SearchBackend):
+    """
+    Uses the GIN index on to_tsvector('simple', text) from migration 0004,
+    so there is nothing to maintain on write.
+    """
+    config = "simple"
+
+    def index_messages(self, messages):
+        pass
+
+    def remove_messages(self, message_ids):
+        pass
+
+    def search_ids(self, room_id, query, after, limit):
+        from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+        from django.db.models import F, Q
+
+        vector = SearchVector("text", config=self.config)
+        search = SearchQuery(" ".join(_TERM.findall(query)), config=self.config)
+        qs = (Message.objects.filter(room_id=room_id)
+              .annotate(document=vector).filter(document=search)
+              .annotate(score=-SearchRank(F("document"), search)))
+        if after is not None:
+            qs = qs.filter(Q(score__gt=after[0]) | Q(score=after[0], pk__gt=after[1]))
+        return [(pk, float(score)) for pk, score in qs.order_by("score", "pk").values_list("pk", "score")[:limit]]
+
+
+class NullSearchBackend(SearchBackend):
+    """Used on databases without a full-text implementation."""
+    def index_messages(self, messages):
+        pass
+
+    def remove_messages(self, message_ids):
+        pass
+
+    def search_ids(self, room_id, query, after, limit):
+        return []
+
+
+_DEFAULT_BACKENDS = {
+    "sqlite": "chat.search.SQLiteFTSBackend",
+    "postgresql": "chat.search.PostgresSearchBackend",
+}
+
+
+@lru_cache(maxsize=None)
+def get_backend() -> SearchBackend:
+    path = getattr(settings, "CHAT_SEARCH_BACKEND", None) or _DEFAULT_BACKENDS.get(
+        connection.vendor, "chat.search.NullSearchBackend")
+    return import_string(path)()
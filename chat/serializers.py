@@ -32,5 +32,5 @@ class RoomSerializer(serializers.ModelSerializer):
         fields = ["id", "name", "members", "last_message"]
 
     def get_last_message(self, obj):
-        last = obj.messages.order_by("created_at").last()
+        last = obj.last_message
         return MessageSerializer(last).data if last else None
@@ -0,0 +1,94 @@
+from django.contrib.auth.signals import user_logged_out
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import audience, auth, backlog, directory, snapshots
+from .archive import is_archiving
+from .models import Message, Room, RoomMembership, User
+from .search import get_backend as search_backend
+
+
+@receiver(post_save, sender=Message, dispatch_uid="chat.backlog.push")
+def push_recent_message(sender, instance: Message, created: bool, **kwargs):
+    if created:
+        transaction.on_commit(lambda: backlog.push(instance))
+
+
+@receiver(post_save, sender=Message, dispatch_uid="chat.search.index")
+def index_message(sender, instance: Message, **kwargs):
+    transaction.on_commit(lambda: search_backend().index_messages([instance]))
+
+
+@receiver(post_delete, sender=Message, dispatch_uid="chat.search.remove")
+def unindex_message(sender, instance: Message, **kwargs):
+    if not is_archiving():  # archive_segment un-indexes the whole batch
+        transaction.on_commit(lambda: search_backend().remove_messages([instance.pk]))
+
+
+@receiver(post_save, sender=Message, dispatch_uid="chat.directory.activity")
+def message_activity_changed(sender, instance: Message, created: bool, **kwargs):
+    if created:
+        transaction.on_commit(directory.activity_changed)
+
+
+@receiver(post_save, sender=Room, dispatch_uid="chat.directory.room_saved")
+def room_changed(sender, instance: Room, update_fields=None, **kwargs):
+    # refresh_last_message() saves only last_message: an activity change.
+    if update_fields is not None and set(update_fields) == {"last_message"}:
+        transaction.on_commit(directory.activity_changed)
+    else:
+        transaction.on_commit(directory.rooms_changed)
+
+
+@receiver(post_delete, sender=Room, dispatch_uid="chat.directory.room_deleted")
+def room_deleted(sender, instance: Room, **kwargs):
+    transaction.on_commit(directory.rooms_changed)
+
+
+@receiver(post_delete, sender=Message, dispatch_uid="chat.backlog.invalidate")
+def invalidate_recent_messages(sender, instance: Message, **kwargs):
+    if not is_archiving():
+        transaction.on_commit(lambda: backlog.invalidate(instance.room_id))
+
+
+@receiver(post_delete, sender=Message, dispatch_uid="chat.room.last_message")
+def repair_last_message(sender, instance: Message, **kwargs):
+    # Queryset deletes skip Message.delete(), and SET_NULL has already
+    # cleared Room.last_message if this row was it.
+    if not is_archiving():
+        transaction.on_commit(lambda: _repair_last_message(instance.room_id))
+
+
+def _repair_last_message(room_id: int):
+    room = Room.objects.filter(pk=room_id, last_message__isnull=True).first()
+    if room is not None and room.messages.exists():
+        room.refresh_last_message()
+
+
+@receiver(user_logged_out, dispatch_uid="chat.auth.logout")
+def forget_logged_out_session(sender, request, user, **kwargs):
+    auth.invalidate_session(request.session.session_key)
+
+
+@receiver(post_save, sender=User, dispatch_uid="chat.auth.user_saved")
+@receiver(post_delete, sender=User, dispatch_uid="chat.auth.user_deleted")
+def forget_user_sessions(sender, instance: User, **kwargs):
+    # Covers password changes and deactivation; cheap enough for every save.
+    transaction.on_commit(lambda: auth.invalidate_user(instance.pk))
+
+
+@receiver(post_save, sender=User, dispatch_uid="chat.snapshots.user_saved")
+def forget_username(sender, instance: User, **kwargs):
+    transaction.on_commit(lambda: snapshots.forget_username(instance.pk))
+
+
+@receiver(post_save, sender=RoomMembership, dispatch_uid="chat.audience.membership_saved")
+def add_presence_peers(sender, instance: RoomMembership, created: bool, **kwargs):
+    if created:
+        transaction.on_commit(lambda: audience.memberships_added([(instance.room_id, instance.user_id)]))
+
+
+@receiver(post_delete, sender=RoomMembership, dispatch_uid="chat.audience.membership_deleted")
+def drop_presence_peers(sender, instance: RoomMembership, **kwargs):
+    transaction.on_commit(lambda: audience.membership_removed(instance.room_id, instance.user_id))
@@ -0,0 +1,79 @@
+import hashlib
+import json
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+
+from . import metrics
+from .encoding import dumps
+from .presence import TTL, online_snapshot_source, version_keys
+from .redis_client import redis_client
+
+USERNAME_TTL = getattr(settings, "PRESENCE_USERNAME_TTL_SECONDS", 60 * 60)
+
+# Serialized bodies of the online-users APIs, one per scope:
+#   presence:snapshot:global, presence:snapshot:room:{id}
+# each stored with the presence versions it was built from and the time
+# its first member expires. A poll is one pipelined round trip while
+# neither has moved; otherwise the body is rebuilt from Redis alone, with
+# usernames from
+#   chat:username:{id}
+# The ETag hashes the body, so a rebuild that changes nothing still 304s.
+
+def _snapshot_key(room_id: Optional[int]) -> str:
+    return "presence:snapshot:global" if room_id is None else f"presence:snapshot:room:{room_id}"
+
+def _username_key(user_id: int) -> str:
+    return f"chat:username:{user_id}"
+
+
+def usernames(user_ids: Iterable[int]) -> Dict[int, str]:
+    """{user_id: username}, from the cache where possible and one query for the rest."""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
+    client = redis_client()
+    names = {uid: raw.decode() for uid, raw in zip(user_ids, client.mget([_username_key(uid) for uid in user_ids]))
+             if raw is not None}
+    missing = [uid for uid in user_ids if uid not in names]
+    if missing:
+        loaded = dict(get_user_model().objects.filter(id__in=missing).values_list("id", "username"))
+        pipe = client.pipeline(transaction=False)
+        for uid, username in loaded.items():
+            pipe.set(_username_key(uid), username, ex=USERNAME_TTL)
+        pipe.execute()
+        names.update(loaded)
+    return names
+
+
+def forget_username(user_id: int) -> None:
+    redis_client().delete(_username_key(user_id))
+
+
+@metrics.instrument("chat_presence_seconds", op="online_snapshot")
+def online_snapshot(room_id: Optional[int] = None) -> Tuple[str, str]:
+    """(ETag, JSON body) of the online users, globally or of one room."""
+    client = redis_client()
+    key = _snapshot_key(room_id)
+    pipe = client.pipeline(transaction=False)
+    pipe.get(key)
+    pipe.mget(version_keys(room_id))
+    raw, versions = pipe.execute()
+    if raw is not None:
+        cached = json.loads(raw)
+        if cached["versions"] == [int(v or 0) for v in versions] and cached["valid_until"] > time.time():
+            return cached["etag"], cached["body"]
+
+    versions, members = online_snapshot_source(room_id)
+    names = usernames(sorted(members))
+    online = [{"id": uid, "username": names[uid]} for uid in sorted(members) if uid in names]
+    body = dumps({"online": online} if room_id is None else {"room_id": room_id, "online": online})
+    etag = '"%s"' % hashlib.sha1(body.encode()).hexdigest()[:20]
+    # Nothing bumps a version when a member merely times out, so the
+    # snapshot also lapses when its first member expires.
+    valid_until = min(members.values(), default=time.time() + TTL)
+    ttl = max(1, int(valid_until - time.time()) + 1)
+    client.set(key, dumps({"versions": list(versions), "valid_until": valid_until, "etag": etag, "body": body}), ex=ttl)
+    return etag, body
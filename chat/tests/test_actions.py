@@ -0,0 +1,46 @@
+from unittest import mock
+
+from django.contrib.auth.models import AnonymousUser
+from django.test import SimpleTestCase
+
+from chat.consumers import ChatConsumer
+
+
+class ActionArgumentTests(SimpleTestCase):
+    def consumer(self, user):
+        consumer = ChatConsumer()
+        consumer.scope = {"user": user}
+        return consumer
+
+    async def test_load_history_requires_authentication(self):
+        data, status = await self.consumer(AnonymousUser()).load_history(pk=1, request_id="r")
+        self.assertEqual(status, 403)
+
+    async def test_load_history_rejects_non_integer_ids(self):
+        consumer = self.consumer(mock.Mock(pk=7, is_authenticated=True))
+        for kwargs in ({"pk": "lobby"}, {"pk": 1, "before_id": "x"}, {"pk": None}):
+            data, status = await consumer.load_history(request_id="r", **kwargs)
+            self.assertEqual(status, 400, kwargs)
+
+    async def test_search_messages_requires_authentication(self):
+        data, status = await self.consumer(AnonymousUser()).search_messages(pk=1, query="hi", request_id="r")
+        self.assertEqual(status, 403)
+
+    async def test_search_messages_rejects_non_integer_pk(self):
+        consumer = self.consumer(mock.Mock(pk=7, is_authenticated=True))
+        for kwargs in ({"pk": "lobby"}, {"pk": 1, "limit": "all"}):
+            data, status = await consumer.search_messages(query="hi", request_id="r", **kwargs)
+            self.assertEqual(status, 400, kwargs)
+
+    async def test_join_room_rejects_non_integer_ids(self):
+        consumer = self.consumer(AnonymousUser())
+        for kwargs in ({"pk": "lobby"}, {"pk": 1, "since_id": "latest"}):
+            data, status = await consumer.join_room(request_id="r", **kwargs)
+            self.assertEqual(status, 400, kwargs)
+
+    async def test_join_rooms_rejects_non_integer_ids(self):
+        consumer = self.consumer(AnonymousUser())
+        for kwargs in ({"pks": ["lobby"]}, {"pks": [1], "since_ids": {"1": "latest"}}, {"pks": [1], "since_ids": [1]}):
+            data, status = await consumer.join_rooms(request_id="r", **kwargs)
+            self.assertEqual(status, 400, kwargs)
+        self.assertEqual(consumer.delivered, {})
@@ -0,0 +1,61 @@
+import sys
+from datetime import timedelta
+from unittest import mock
+
+from django.utils import timezone
+
+from chat import backlog
+from chat.archive import archive_room
+from chat.models import ArchivedSegment, Message, Room, RoomMembership, User
+from chat.search import get_backend as search_backend
+
+from .utils import FakeRedisTestCase
+
+
+class ArchiveRoomTests(FakeRedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user("alice", password="x")
+        self.room = Room.objects.create(name="archive")
+        old = timezone.now() - timedelta(days=365)
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(5):
+                msg = Message.objects.create(room=self.room, user=self.user, text=f"needle {i}")
+                Message.objects.filter(pk=msg.pk).update(created_at=old + timedelta(seconds=i))
+        self.room.refresh_from_db()
+        self.old = old
+        self.cutoff = timezone.now() - timedelta(days=1)
+
+    def test_archiving_broadcasts_no_deletes(self):
+        import chat.consumers  # noqa: F401  registers the message_activity observer
+
+        # The package re-exports a model_observer function over the module name.
+        observer_module = sys.modules["djangochannelsrestframework.observer.model_observer"]
+        with mock.patch.object(observer_module, "get_channel_layer") as get_channel_layer, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(archive_room(self.room.pk, self.cutoff, segment_size=2), 4)
+        get_channel_layer.assert_not_called()
+        self.assertEqual(ArchivedSegment.objects.filter(room=self.room).count(), 2)
+        self.assertEqual(list(Message.objects.filter(room=self.room).values_list("pk", flat=True)),
+                         [self.room.last_message_id])
+
+    def test_archived_messages_leave_search_and_backlog(self):
+        backlog.recent_messages(self.room.pk)
+        with mock.patch.object(backlog, "invalidate", wraps=backlog.invalidate) as invalidate, \
+                self.captureOnCommitCallbacks(execute=True):
+            archive_room(self.room.pk, self.cutoff, segment_size=2)
+        self.assertEqual(invalidate.call_count, 2)
+        hits, _ = search_backend().search(self.room.pk, "needle")
+        self.assertEqual([m.pk for m, _ in hits], [self.room.last_message_id])
+
+    def test_archived_unread_messages_leave_unread_counts(self):
+        bob = User.objects.create_user("bob", password="x")
+        # Read up to "needle 1": needles 2-4 are unread, 2 and 3 get archived.
+        RoomMembership.objects.create(room=self.room, user=bob, unread_count=3,
+                                      last_seen=self.old + timedelta(seconds=1.5))
+        author = RoomMembership.objects.create(room=self.room, user=self.user, last_seen=self.old)
+        with self.captureOnCommitCallbacks(execute=True):
+            archive_room(self.room.pk, self.cutoff, segment_size=2)
+        self.assertEqual(RoomMembership.objects.get(room=self.room, user=bob).unread_count, 1)
+        author.refresh_from_db()
+        self.assertEqual(author.unread_count, 0)
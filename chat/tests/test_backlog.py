@@ -0,0 +1,50 @@
+from unittest import mock
+
+from chat import backlog
+from chat.models import Message, Room, User
+
+from .utils import FakeRedisTestCase
+
+
+class RecentBufferTests(FakeRedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user("alice", password="x")
+        self.room = Room.objects.create(name="backlog")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.first = Message.objects.create(room=self.room, user=self.user, text="first")
+
+    def texts(self):
+        return [m["text"] for m in backlog.recent_messages(self.room.pk)]
+
+    def test_pushes_append_to_a_built_buffer(self):
+        self.assertEqual(self.texts(), ["first"])
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.create(room=self.room, user=self.user, text="second")
+        self.assertEqual(self.texts(), ["first", "second"])
+
+    def test_message_committed_during_rebuild_is_kept(self):
+        read = backlog.messages_before
+
+        def read_then_commit(room_id, limit):
+            page = read(room_id, limit=limit)
+            if read_then_commit.racing:
+                read_then_commit.racing = False
+                with self.captureOnCommitCallbacks(execute=True):
+                    Message.objects.create(room=self.room, user=self.user, text="racer")
+            return page
+        read_then_commit.racing = True
+
+        with mock.patch.object(backlog, "messages_before", side_effect=read_then_commit):
+            self.assertEqual(self.texts(), ["first", "racer"])
+        self.assertEqual(self.texts(), ["first", "racer"])
+
+    def test_gives_up_caching_when_every_read_races(self):
+        def always_racing(room_id, limit):
+            backlog.invalidate(room_id)
+            return []
+
+        with mock.patch.object(backlog, "messages_before", side_effect=always_racing) as read:
+            self.assertEqual(backlog.rebuild(self.room.pk), [])
+        self.assertEqual(read.call_count, backlog.REBUILD_ATTEMPTS)
+        self.assertFalse(self.redis.exists(backlog._recent_key(self.room.pk)))
@@ -0,0 +1,77 @@
+from datetime import timedelta
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from chat.history import messages_after, messages_before, resume_many
+from chat.models import Message, Room, User
+
+
+class KeysetHistoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("alice", password="x")
+        cls.room = Room.objects.create(name="history")
+        cls.other = Room.objects.create(name="elsewhere")
+        start = timezone.now() - timedelta(hours=1)
+        cls.ids = []
+        for i in range(10):
+            msg = Message.objects.create(room=cls.room, user=cls.user, text=f"m{i}")
+            # Pairs share a timestamp, so ordering has to fall back to the id.
+            Message.objects.filter(pk=msg.pk).update(created_at=start + timedelta(seconds=i // 2))
+            cls.ids.append(msg.pk)
+        Message.objects.create(room=cls.other, user=cls.user, text="not here")
+
+    def ids_of(self, messages):
+        return [m.pk for m in messages]
+
+    def test_latest_page_is_oldest_first(self):
+        self.assertEqual(self.ids_of(messages_before(self.room.pk, limit=4)), self.ids[-4:])
+
+    def test_pages_walk_back_without_gaps_or_repeats(self):
+        seen, before = [], None
+        while True:
+            page = messages_before(self.room.pk, before, limit=3)
+            if not page:
+                break
+            seen = self.ids_of(page) + seen
+            before = page[0].pk
+        self.assertEqual(seen, self.ids)
+
+    def test_tie_break_on_equal_created_at(self):
+        # ids[4] and ids[5] share created_at: paging from ids[5] must return ids[4] next.
+        self.assertEqual(self.ids_of(messages_before(self.room.pk, self.ids[5], limit=1)), [self.ids[4]])
+        self.assertEqual(self.ids_of(messages_after(self.room.pk, self.ids[4], limit=1)), [self.ids[5]])
+
+    def test_unknown_anchor(self):
+        self.assertEqual(messages_before(self.room.pk, 10 ** 9), [])
+        self.assertIsNone(messages_after(self.room.pk, 10 ** 9))
+
+    def test_resume_many_matches_per_room_reads(self):
+        other = Message.objects.filter(room=self.other).values_list("pk", flat=True).first()
+        resumed = resume_many({self.room.pk: self.ids[4], self.other.pk: other}, limit=6)
+        self.assertEqual(self.ids_of(resumed[self.room.pk][0]), self.ids[5:])
+        self.assertEqual(resumed[self.other.pk], ([], False))
+
+    def test_resume_many_asks_for_resync(self):
+        resumed = resume_many({self.room.pk: self.ids[0]}, limit=3)
+        self.assertEqual(resumed[self.room.pk], ([], True))
+        # Unknown ids and ids of another room cannot anchor a replay either.
+        self.assertEqual(resume_many({self.room.pk: 10 ** 9})[self.room.pk], ([], True))
+        other = Message.objects.filter(room=self.other).values_list("pk", flat=True).first()
+        self.assertEqual(resume_many({self.room.pk: other})[self.room.pk], ([], True))
+
+    def test_page_query_seeks_the_room_created_id_index(self):
+        with CaptureQueriesContext(connection) as queries:
+            messages_before(self.room.pk, self.ids[5], limit=3)
+        # The page query is the one joining the author (select_related("user")).
+        page_sql = next(q["sql"] for q in queries if "JOIN" in q["sql"])
+        if connection.vendor != "sqlite":
+            self.skipTest("plan assertion is written against SQLite's EXPLAIN QUERY PLAN")
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + page_sql)
+            plan = " ".join(str(row[-1]) for row in cursor.fetchall())
+        self.assertIn("chat_msg_room_created_id_idx", plan)
+        self.assertNotIn("USE TEMP B-TREE FOR ORDER BY", plan)
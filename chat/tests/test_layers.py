@@ -0,0 +1,63 @@
+import asyncio
+import threading
+
+from django.test import SimpleTestCase
+
+from chat.layers import NodeLocalRedisChannelLayer
+
+
+class NodeLocalFanoutTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        from fakeredis import TcpFakeServer
+        cls.server = TcpFakeServer(("127.0.0.1", 0), server_type="redis")
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def make_layer(self):
+        return NodeLocalRedisChannelLayer(hosts=[self.server.server_address], prefix=f"test{id(self)}")
+
+    async def test_group_send_reaches_every_waiting_local_member(self):
+        layer = self.make_layer()
+        first, second = await layer.new_channel(), await layer.new_channel()
+        await layer.group_add("room", first)
+        await layer.group_add("room", second)
+        # Both are already receiving, so one of them holds channels_redis'
+        # receive lock and is blocked in BZPOPMIN when the message arrives.
+        receivers = [asyncio.ensure_future(layer.receive(channel)) for channel in (first, second)]
+        await asyncio.sleep(0.1)
+        await layer.group_send("room", {"type": "chat.message", "text": "hi"})
+        messages = await asyncio.wait_for(asyncio.gather(*receivers), timeout=5)
+        self.assertEqual([m["text"] for m in messages], ["hi", "hi"])
+        await layer.flush()
+
+    async def test_direct_messages_still_arrive_after_local_ones(self):
+        layer = self.make_layer()
+        first, second = await layer.new_channel(), await layer.new_channel()
+        await layer.group_add("room", first)
+        await layer.group_add("room", second)
+        other = asyncio.ensure_future(layer.receive(second))
+        await layer.group_send("room", {"type": "chat.message", "text": "group"})
+        self.assertEqual((await asyncio.wait_for(layer.receive(first), timeout=5))["text"], "group")
+        await layer.send(first, {"type": "chat.message", "text": "direct"})
+        self.assertEqual((await asyncio.wait_for(layer.receive(first), timeout=5))["text"], "direct")
+        self.assertEqual((await asyncio.wait_for(other, timeout=5))["text"], "group")
+        await layer.flush()
+
+    async def test_discarded_member_gets_nothing(self):
+        layer = self.make_layer()
+        first, second = await layer.new_channel(), await layer.new_channel()
+        await layer.group_add("room", first)
+        await layer.group_add("room", second)
+        await layer.group_discard("room", second)
+        await layer.group_send("room", {"type": "chat.message", "text": "hi"})
+        self.assertEqual((await asyncio.wait_for(layer.receive(first), timeout=5))["text"], "hi")
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive(second), timeout=0.3)
+        await layer.flush()
@@ -0,0 +1,167 @@
+import asyncio
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from chat import presence, snapshots
+from chat.models import User
+from chat.tests.utils import FakeRedisTestCase
+
+
+class PresenceSetTests(FakeRedisTestCase):
+    def at(self, when):
+        """Run presence code as if the clock read `when`."""
+        return mock.patch.object(presence.time, "time", return_value=when)
+
+    def test_heartbeat_marks_user_online_until_ttl(self):
+        now = time.time()
+        with self.at(now):
+            presence.heartbeat(1)
+            presence.heartbeat_many([2, 3])
+            self.assertEqual(sorted(presence.list_online_user_ids()), [1, 2, 3])
+        self.assertAlmostEqual(self.redis.zscore("presence:global:users", 1), now + presence.TTL)
+
+    def test_expired_users_are_not_listed(self):
+        now = time.time()
+        with self.at(now):
+            presence.heartbeat(1)
+        with self.at(now + presence.TTL / 2):
+            presence.heartbeat(2)
+        with self.at(now + presence.TTL + 1):
+            self.assertEqual(presence.list_online_user_ids(), [2])
+            self.assertEqual(presence.online_among([1, 2, 3]), [2])
+
+    def test_remove_global(self):
+        presence.heartbeat_many([1, 2])
+        presence.remove_global(1)
+        self.assertEqual(presence.list_online_user_ids(), [2])
+
+    def test_room_members_are_intersected_with_the_live_global_set(self):
+        now = time.time()
+        with self.at(now):
+            presence.room_join(1, 10)
+            presence.room_join(2, 10)
+            presence.room_join(3, 11)
+            self.assertEqual(sorted(presence.room_online_user_ids(10)), [1, 2])
+            presence.remove_global(2)
+            self.assertEqual(presence.room_online_user_ids(10), [1])
+            presence.room_leave(1, 10)
+            self.assertEqual(presence.room_online_user_ids(10), [])
+        with self.at(now + presence.TTL + 1):
+            self.assertEqual(presence.room_online_user_ids(11), [])
+
+    def test_reads_do_not_prune(self):
+        now = time.time()
+        with self.at(now):
+            presence.room_join(1, 10)
+        with self.at(now + presence.TTL + 1):
+            presence.list_online_user_ids()
+            presence.room_online_user_ids(10)
+        self.assertEqual(self.redis.zcard("presence:global:users"), 1)
+        self.assertEqual(self.redis.zcard("presence:room:10:users"), 1)
+
+    def test_expire_global_prunes_in_batches(self):
+        now = time.time()
+        with self.at(now - presence.TTL - 1):
+            presence.heartbeat_many(range(1, 6))
+        with self.at(now):
+            presence.heartbeat(6)
+            self.assertEqual(len(presence.expire_global(3)), 3)
+            self.assertEqual(len(presence.expire_global(3)), 2)
+            self.assertEqual(presence.expire_global(3), [])
+        self.assertEqual(presence.list_online_user_ids(), [6])
+
+    def test_sweep_rooms_drops_members_no_longer_online(self):
+        now = time.time()
+        with self.at(now - presence.TTL - 1):
+            presence.room_join(1, 10)
+        with self.at(now):
+            presence.room_join(2, 10)
+            presence.room_join(3, 11)
+            presence.remove_global(3)
+            removed, cursor = {}, 0
+            while True:
+                cursor, _, batch = presence.sweep_rooms(cursor, 1)
+                removed.update(batch)
+                if not cursor:
+                    break
+        self.assertEqual(removed, {10: [1], 11: [3]})
+        self.assertEqual(self.redis.zrange("presence:room:10:users", 0, -1), [b"2"])
+        self.assertFalse(self.redis.exists("presence:room:11:users"))
+
+    def test_versions_move_only_on_membership_change(self):
+        presence.heartbeat(1)
+        self.assertEqual(self.redis.get("presence:global:version"), b"1")
+        presence.heartbeat_many([1])
+        self.assertEqual(self.redis.get("presence:global:version"), b"1")
+        presence.room_join(1, 10)
+        self.assertEqual(self.redis.get("presence:room:10:version"), b"1")
+        presence.room_leave(1, 10)
+        self.assertEqual(self.redis.get("presence:room:10:version"), b"2")
+
+    def test_expired_user_coming_back_invalidates_the_snapshot(self):
+        a = User.objects.create_user("a", password="x")
+        b = User.objects.create_user("b", password="x")
+        now = time.time()
+
+        def snapshot_at(when):
+            with self.at(when), mock.patch.object(snapshots.time, "time", return_value=when):
+                return snapshots.online_snapshot()
+
+        with self.at(now):
+            presence.heartbeat_many([a.pk, b.pk])
+        later = now + presence.TTL / 2
+        with self.at(later):
+            presence.heartbeat(b.pk)
+        # a has expired but is still in the set: nothing has swept it.
+        etag, body = snapshot_at(now + presence.TTL + 1)
+        self.assertNotIn('"a"', body)
+        with self.at(now + presence.TTL + 2):
+            presence.heartbeat(a.pk)
+        fresh_etag, body = snapshot_at(now + presence.TTL + 3)
+        self.assertIn('"a"', body)
+        self.assertNotEqual(fresh_etag, etag)
+
+
+class HeartbeatBatcherTests(SimpleTestCase):
+    async def test_failed_flush_is_logged_and_later_windows_still_flush(self):
+        batcher = presence.HeartbeatBatcher(interval=0.001)
+        written = []
+
+        def heartbeat_many(ids):
+            if not written:
+                written.append(None)
+                raise ConnectionError("redis down")
+            written.append(set(ids))
+
+        with mock.patch.object(presence, "heartbeat_many", heartbeat_many), \
+                self.assertLogs("chat.batching", "ERROR"):
+            batcher.add(1)
+            await asyncio.sleep(0.05)
+            batcher.add(2)
+            await asyncio.sleep(0.05)
+        self.assertEqual(written, [None, {2}])
+
+
+class PresenceBroadcasterTests(SimpleTestCase):
+    async def test_zero_window_announces_every_transition_in_order(self):
+        broadcaster = presence.PresenceBroadcaster(interval=0)
+        with mock.patch.object(presence, "announce", new=mock.AsyncMock()) as announce:
+            broadcaster.online(1)
+            broadcaster.offline(1)
+            broadcaster.online(1)
+            await asyncio.sleep(0.01)
+        self.assertEqual(announce.await_args_list, [
+            mock.call([1], [], kind="presence_batch"),
+            mock.call([], [1], kind="presence_batch"),
+            mock.call([1], [], kind="presence_batch"),
+        ])
+
+    async def test_window_debounces_a_quick_reconnect(self):
+        broadcaster = presence.PresenceBroadcaster(interval=0.001)
+        with mock.patch.object(presence, "announce", new=mock.AsyncMock()) as announce:
+            broadcaster.offline(1)
+            broadcaster.online(1)
+            await asyncio.sleep(0.01)
+        announce.assert_awaited_once_with([], [], kind="presence_batch")
@@ -0,0 +1,33 @@
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from chat import consumers
+from chat.consumers import ChatConsumer
+
+
+class ReadPositionTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(consumers, "read_position_writer")
+        self.writer = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.consumer = ChatConsumer()
+        self.consumer.scope = {"user": mock.Mock(pk=7, is_authenticated=True)}
+
+    def test_join_rooms_subscribes_without_reading(self):
+        self.consumer.joined(1, 40, read=False)
+        self.assertEqual(self.consumer.delivered, {1: 40})
+        self.assertEqual(self.consumer.read_positions, {})
+        self.writer.update.assert_not_called()
+
+    def test_join_room_reads_what_it_returns(self):
+        self.consumer.joined(1, 40, read=True)
+        self.assertEqual(self.consumer.read_positions, {1: 40})
+        self.writer.update.assert_called_once_with(7, 1, 40)
+
+    def test_mark_read_only_moves_forward(self):
+        self.consumer.joined(1, 40, read=False)
+        self.consumer.move_read_position(1, 42)
+        self.consumer.move_read_position(1, 41)
+        self.assertEqual(self.consumer.read_positions, {1: 42})
+        self.assertEqual(self.writer.update.call_args_list, [mock.call(7, 1, 42)])
@@ -0,0 +1,118 @@
+from django.test import TestCase
+
+from chat.consumers import ChatConsumer
+from chat.models import Message, Room, RoomMembership, User
+from chat.serializers import RoomSerializer
+
+from .utils import FakeRedisTestCase
+
+
+class RoomSnapshotQueryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        users = [User.objects.create_user(f"user{i}", password="x") for i in range(3)]
+        for i in range(20):
+            room = Room.objects.create(name=f"room{i}")
+            for user in users:
+                RoomMembership.objects.create(room=room, user=user)
+                Message.objects.create(room=room, user=user, text=f"hello {i}")
+
+    def serialize(self, count):
+        rooms = Room.objects.with_snapshot().order_by("pk")[:count]
+        return RoomSerializer(rooms, many=True).data
+
+    def test_query_count_does_not_grow_with_rooms(self):
+        # Rooms with last_message and its author, then all memberships with their users.
+        for count in (1, 5, 20):
+            with self.subTest(rooms=count), self.assertNumQueries(2):
+                data = self.serialize(count)
+            self.assertEqual(len(data), count)
+
+    def test_snapshot_content(self):
+        room = self.serialize(1)[0]
+        self.assertEqual(len(room["members"]), 3)
+        self.assertEqual(room["last_message"]["text"], "hello 0")
+        self.assertEqual(room["last_message"]["user"]["username"], "user2")
+
+
+class JoinPositionTests(FakeRedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user("alice", password="x")
+        self.room = Room.objects.create(name="join")
+        self.ids = [Message.objects.create(room=self.room, user=self.user, text=f"m{i}").pk for i in range(3)]
+
+    def snapshot(self, room, since_id=None):
+        return ChatConsumer.room_snapshots([room], {room.pk: since_id}, {})[room.pk]
+
+    def test_position_is_newest_message_sent_not_stale_room_row(self):
+        stale = Room.objects.with_snapshot().get(pk=self.room.pk)
+        newer = Message.objects.create(room=self.room, user=self.user, text="after the room was read")
+        data, position = self.snapshot(stale)
+        self.assertEqual(data["recent_messages"][-1]["id"], newer.pk)
+        self.assertEqual(position, newer.pk)
+
+    def test_position_covers_the_replay(self):
+        room = Room.objects.with_snapshot().get(pk=self.room.pk)
+        data, position = self.snapshot(room, self.ids[0])
+        self.assertEqual([m["id"] for m in data["missed_messages"]], self.ids[1:])
+        self.assertEqual(position, self.ids[-1])
+
+    def test_empty_room_has_no_position(self):
+        room = Room.objects.with_snapshot().get(pk=Room.objects.create(name="empty").pk)
+        self.assertEqual(self.snapshot(room)[1], None)
+
+
+class LastMessageTests(FakeRedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user("alice", password="x")
+        self.room = Room.objects.create(name="last")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ids = [Message.objects.create(room=self.room, user=self.user, text=f"m{i}").pk for i in range(3)]
+
+    def test_queryset_delete_of_the_last_message_is_repaired(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.filter(pk__in=self.ids[1:]).delete()
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_message_id, self.ids[0])
+
+    def test_deleting_every_message_leaves_no_last_message(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.filter(room=self.room).delete()
+        self.room.refresh_from_db()
+        self.assertIsNone(self.room.last_message_id)
+
+
+class JoinRoomsQueryTests(FakeRedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user("alice", password="x")
+        other = User.objects.create_user("bob", password="x")
+        self.rooms, self.missed = [], {}
+        for i in range(40):
+            room = Room.objects.create(name=f"room{i}")
+            seen = Message.objects.create(room=room, user=other, text="seen")
+            RoomMembership.objects.create(room=room, user=self.user)
+            RoomMembership.objects.filter(room=room, user=self.user).update(last_seen=seen.created_at)
+            self.missed[room.pk] = [Message.objects.create(room=room, user=other, text=f"new {n}").pk
+                                    for n in range(2)]
+            self.rooms.append(room.pk)
+        ChatConsumer().load_snapshots(self.user, self.rooms, {})  # warm the recent buffers
+
+    def test_query_count_does_not_grow_with_rooms(self):
+        consumer = ChatConsumer()
+        for count in (1, 10, 40):
+            pks = self.rooms[:count]
+            with self.subTest(rooms=count), self.assertNumQueries(5):
+                snapshots, new_members = consumer.load_snapshots(self.user, pks, {})
+            self.assertEqual(new_members, [])
+            for pk in pks:
+                data, position = snapshots[pk]
+                self.assertEqual([m["id"] for m in data["missed_messages"]], self.missed[pk])
+                self.assertEqual(position, self.missed[pk][-1])
+
+    def test_since_id_wins_over_the_read_anchor(self):
+        pk = self.rooms[0]
+        snapshots, _ = ChatConsumer().load_snapshots(self.user, [pk], {pk: self.missed[pk][0]})
+        self.assertEqual([m["id"] for m in snapshots[pk][0]["missed_messages"]], self.missed[pk][1:])
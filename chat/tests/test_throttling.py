@@ -0,0 +1,88 @@
+import asyncio
+import json
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from chat import wire
+from chat.consumers import ChatConsumer
+from chat.throttling import BoundedSendMixin
+
+
+class SlowSocket:
+    """Stands in for the ASGI consumer: send() blocks until the gate opens."""
+    scope = {}
+    channel_name = "test.slow"
+
+    def __init__(self):
+        self.sent = []
+        self.gate = asyncio.Event()
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        await self.gate.wait()
+        self.sent.append(text_data if bytes_data is None else wire.unpack(bytes_data))
+
+    async def close(self, code=None):
+        self.closed = code
+
+    @classmethod
+    async def encode_json(cls, content):
+        return json.dumps(content)
+
+
+class Consumer(wire.WireProtocolMixin, BoundedSendMixin, SlowSocket):
+    send_queue_size = 2
+    send_overflow_policy = "coalesce"
+    dropped_calls = 0
+
+    def frames_dropped(self):
+        self.dropped_calls += 1
+
+
+class BoundedSendTests(SimpleTestCase):
+    async def overflow(self, consumer):
+        await consumer.send_json({"n": 0})
+        await asyncio.sleep(0)  # the writer takes frame 0 and blocks on it
+        for n in range(1, 4):
+            await consumer.send_json({"n": n})
+        consumer.gate.set()
+        await asyncio.sleep(0.01)
+        consumer._send_task.cancel()
+        return consumer.sent
+
+    async def test_coalesced_notice_is_msgpack_for_binary_clients(self):
+        consumer = Consumer()
+        consumer.binary = True
+        sent = await self.overflow(consumer)
+        self.assertEqual(sent, [{"n": 0}, {"type": "overflow", "dropped": 2, "resync": True}, {"n": 3}])
+        self.assertEqual(consumer.dropped_calls, 1)
+
+    async def test_coalesced_notice_is_json_for_text_clients(self):
+        sent = await self.overflow(Consumer())
+        self.assertEqual([json.loads(frame) for frame in sent],
+                         [{"n": 0}, {"type": "overflow", "dropped": 2, "resync": True}, {"n": 3}])
+
+    async def test_queue_size_zero_sends_straight_through(self):
+        consumer = Consumer()
+        consumer.send_queue_size = 0
+        consumer.gate.set()
+        await consumer.send_json({"n": 0})
+        self.assertEqual([json.loads(frame) for frame in consumer.sent], [{"n": 0}])
+        self.assertIsNone(consumer._send_task)
+
+    async def test_failed_writer_is_logged_and_closes_the_socket(self):
+        consumer = Consumer()
+        consumer.gate.set()
+        with mock.patch.object(SlowSocket, "send", side_effect=OSError("gone")), \
+                self.assertLogs("chat.throttling", "ERROR"):
+            await consumer.send_json({"n": 0})
+            await asyncio.sleep(0.01)
+        self.assertEqual(consumer.closed, 1011)
+        await consumer.send_json({"n": 1})
+        self.assertFalse(consumer._send_queue)
+
+    def test_dropping_frames_forgets_interned_users(self):
+        consumer = ChatConsumer()
+        consumer.interned_users.update({1, 2})
+        consumer.frames_dropped()
+        self.assertEqual(consumer.interned_users, set())
@@ -0,0 +1,29 @@
+import fakeredis
+from django.conf import settings
+from django.test import TestCase, override_settings
+
+from chat.redis_client import redis_client
+
+# The default cache, with django_redis talking to an in-process fakeredis
+# server instead of the configured Redis.
+FAKE_REDIS_CACHES = {
+    "default": {
+        **settings.CACHES["default"],
+        "OPTIONS": {
+            **settings.CACHES["default"].get("OPTIONS", {}),
+            "CONNECTION_POOL_KWARGS": {"connection_class": fakeredis.FakeConnection},
+        },
+    },
+}
+
+# Observer broadcasts sent from on_commit callbacks stay in process.
+IN_MEMORY_CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+
+@override_settings(CACHES=FAKE_REDIS_CACHES, CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class FakeRedisTestCase(TestCase):
+    """TestCase whose Redis-backed helpers run against an empty fakeredis."""
+    def setUp(self):
+        super().setUp()
+        self.redis = redis_client()
+        self.redis.flushall()
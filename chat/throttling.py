@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+from typing import Dict, Tuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# action name -> (tokens per second, burst size); unlisted actions are not limited
+RATE_LIMITS: Dict[str, Tuple[float, int]] = getattr(settings, "CHAT_RATE_LIMITS", {
+    "create_message": (5, 20),
+    "search_messages": (1, 5),
+    "send_event": (2, 5),
+})
+# 0 sends every frame straight to the ASGI server, with no queue.
+SEND_QUEUE_SIZE = getattr(settings, "CHAT_SEND_QUEUE_SIZE", 0)
+# "drop" | "coalesce" | "disconnect"
+OVERFLOW_POLICY = getattr(settings, "CHAT_SEND_OVERFLOW_POLICY", "coalesce")
+
+# event -> count, e.g. "throttled.create_message", "overflow.coalesce"
+counters: Counter = Counter()
+# client key -> number of throttled or overflowed frames
+offenders: Counter = Counter()
+
+
+def stats(top: int = 20) -> dict:
+    return {
+        "counters": dict(counters),
+        "top_clients": [{"client": key, "count": n} for key, n in offenders.most_common(top)],
+    }
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class RateLimiter:
+    """In-process token buckets keyed by (client, action)."""
+    max_buckets = 100_000
+
+    def __init__(self, limits: Dict[str, Tuple[float, int]]):
+        self.limits = limits
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = {}
+
+    def allow(self, client: str, action: str) -> bool:
+        limit = self.limits.get(action)
+        if limit is None:
+            return True
+        key = (client, action)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets:
+                self._prune()
+            bucket = self._buckets[key] = TokenBucket(*limit)
+        if bucket.take():
+            return True
+        counters[f"throttled.{action}"] += 1
+        offenders[client] += 1
+        return False
+
+    def _prune(self):
+        # A bucket that has refilled completely carries no state worth keeping.
+        now = time.monotonic()
+        self._buckets = {
+            key: b for key, b in self._buckets.items()
+            if b.tokens + (now - b.updated) * b.rate < b.capacity
+        }
+
+
+rate_limiter = RateLimiter(RATE_LIMITS)
+
+
+def client_key(consumer) -> str:
+    user = consumer.scope.get("user")
+    if user is not None and user.is_authenticated:
+        return f"user:{user.pk}"
+    return f"channel:{consumer.channel_name}"
+
+
+class BoundedSendMixin:
+    """
+    Routes WebSocket sends through a per-connection queue of at most
+    send_queue_size frames, drained by one writer task. When a client falls
+    behind, send_overflow_policy decides what happens:
+      - drop:       discard the new frame
+      - coalesce:   replace everything queued with one
+                    {"type": "overflow", "dropped": n, "resync": true} frame
+      - disconnect: close the socket with code 4008
+    Backpressure only shows up here when the ASGI server's send() waits
+    for the transport to drain, as uvicorn's does. Daphne's send() hands the
+    frame to Twisted and returns at once, so under Daphne the queue never
+    fills and none of these policies ever triggers. A send_queue_size of 0
+    (the default) therefore skips the queue and sends directly.
+    """
+    send_queue_size = SEND_QUEUE_SIZE
+    send_overflow_policy = OVERFLOW_POLICY
+
+    _send_queue = None
+    _send_ready = None
+    _send_task = None
+    _send_dropped = 0
+    _send_closed = False
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        if self._send_closed:
+            return
+        if not self.send_queue_size:
+            await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+            return
+        if self._send_task is None:
+            self._send_queue = deque()
+            self._send_ready = asyncio.Event()
+            self._send_task = asyncio.get_running_loop().create_task(self._drain_send_queue())
+        if len(self._send_queue) >= self.send_queue_size:
+            if not await self._send_overflow():
+                return
+        self._send_queue.append((text_data, bytes_data, close))
+        self._send_ready.set()
+
+    async def send_json(self, content, close=False):
+        # AsyncJsonWebsocketConsumer.send_json calls the base send directly.
+        text_data, bytes_data = await self.encode_frame(content)
+        await self.send(text_data=text_data, bytes_data=bytes_data, close=close)
+
+    async def encode_frame(self, content):
+        """(text_data, bytes_data) of a frame carrying `content`."""
+        return await self.encode_json(content), None
+
+    def frames_dropped(self):
+        """Called whenever frames are discarded, before anything else is sent."""
+
+    async def _send_overflow(self) -> bool:
+        """Apply the overflow policy; returns whether the new frame should be queued."""
+        policy = self.send_overflow_policy
+        counters[f"overflow.{policy}"] += 1
+        offenders[client_key(self)] += 1
+        self.frames_dropped()
+        if policy == "coalesce":
+            # None marks the overflow notice; it is rendered when sent so the
+            # dropped count covers everything discarded until then.
+            self._send_dropped += sum(1 for frame in self._send_queue if frame is not None)
+            self._send_queue.clear()
+            self._send_queue.append(None)
+            return True
+        if policy == "disconnect":
+            self._send_closed = True
+            self._send_queue.clear()
+            await self.close(code=4008)
+        return False
+
+    async def _drain_send_queue(self):
+        try:
+            while True:
+                await self._send_ready.wait()
+                while self._send_queue:
+                    frame = self._send_queue.popleft()
+                    if frame is None:
+                        notice = {"type": "overflow", "dropped": self._send_dropped, "resync": True}
+                        self._send_dropped = 0
+                        frame = (*await self.encode_frame(notice), False)
+                    text_data, bytes_data, close = frame
+                    await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+                self._send_ready.clear()
+        except Exception:
+            # Without the writer nothing more reaches the client: close
+            # rather than leave a silent socket.
+            logger.exception("Send queue writer failed for %s", client_key(self))
+            self._send_closed = True
+            self._send_queue.clear()
+            try:
+                await self.close(code=1011)
+            except Exception:
+                pass
+
+    async def websocket_disconnect(self, message):
+        if self._send_task is not None:
+            self._send_task.cancel()
+        await super().websocket_disconnect(message)
@@ -0,0 +1,40 @@
+from typing import Dict, Tuple
+
+from django.conf import settings
+
+from . import metrics
+from .history import save_read_positions_many
+from .batching import WindowedBatch
+
+READ_POSITION_FLUSH_SECONDS = getattr(settings, "CHAT_READ_POSITION_FLUSH_SECONDS", 5)
+
+
+class ReadPositionWriter(WindowedBatch):
+    """
+    Coalesces read-position updates so each membership is written at most
+    once per interval, however many messages were read in between. Only
+    the furthest position per (user, room) is kept.
+    """
+    def __init__(self, interval: float = READ_POSITION_FLUSH_SECONDS):
+        super().__init__(interval)
+        self._pending: Dict[Tuple[int, int], int] = {}
+
+    def update(self, user_id: int, room_id: int, message_id: int) -> None:
+        key = (user_id, room_id)
+        if message_id > self._pending.get(key, 0):
+            self._pending[key] = message_id
+        self._schedule()
+
+    def discard(self, user_id: int, room_id: int) -> None:
+        self._pending.pop((user_id, room_id), None)
+
+    def _has_pending(self) -> bool:
+        return bool(self._pending)
+
+    async def flush(self) -> None:
+        positions, self._pending = self._pending, {}
+        if positions:
+            await metrics.db_hop(save_read_positions_many, "save_read_positions_many", write=True)(positions)
+
+
+read_position_writer = ReadPositionWriter()
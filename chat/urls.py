@@ -15,6 +15,11 @@ urlpatterns = [
     path("signup/", views.signup, name="signup"),
 
     path("accounts/login/", RedirectView.as_view(pattern_name="login", permanent=False)),
+    path("api/rooms/", views.rooms_api, name="rooms_api"),
     path("api/online/", views.online_users_api, name="online_users_api"),
     path("api/room/<int:pk>/online/", views.room_online_users_api, name="room_online_users_api"),
+    path("api/room/<int:pk>/search/", views.room_search_api, name="room_search_api"),
+    path("api/unread/", views.unread_counts_api, name="unread_counts_api"),
+    path("api/metrics/", views.metrics_api, name="metrics_api"),
+    path("api/throttling/", views.throttling_stats_api, name="throttling_stats_api"),
 ]
@@ -1,26 +1,60 @@
 from django.contrib.auth import logout, login, authenticate
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.shortcuts import get_object_or_404, redirect, render
 from django.http import HttpResponseRedirect
 from django.urls import reverse
-from django.http import JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse
 from django.contrib.auth import get_user_model
-from .presence import list_online_user_ids, room_online_user_ids
+from django.utils.cache import get_conditional_response
+from .snapshots import online_snapshot
+from .history import PAGE_SIZE, messages_before, unread_counts
+from . import directory, metrics, throttling
 
 from .models import Room
+from .search import PAGE_SIZE as SEARCH_PAGE_SIZE, MAX_PAGE_SIZE as SEARCH_MAX_PAGE_SIZE, get_backend as search_backend
+from .serializers import MessageSerializer
 from .forms import CustomUserCreationForm
 
 User = get_user_model()
 
+def _snapshot_response(request, snapshot):
+    """Serve an (ETag, JSON body) snapshot, answering a matching If-None-Match with 304."""
+    etag, body = snapshot
+    response = HttpResponse(body, content_type="application/json")
+    response["ETag"] = etag
+    return get_conditional_response(request, etag=etag, response=response)
+
 def online_users_api(request):
-    ids = list_online_user_ids()
-    users = list(User.objects.filter(id__in=ids).values("id", "username"))
-    return JsonResponse({"online": users})
+    return _snapshot_response(request, online_snapshot())
 
 def room_online_users_api(request, pk: int):
-    ids = room_online_user_ids(int(pk))
-    users = list(User.objects.filter(id__in=ids).values("id", "username"))
-    return JsonResponse({"room_id": pk, "online": users})
+    return _snapshot_response(request, online_snapshot(int(pk)))
+
+@login_required
+def unread_counts_api(request):
+    return JsonResponse({"unread": unread_counts(request.user)})
+
+@staff_member_required
+def throttling_stats_api(request):
+    return JsonResponse(throttling.stats())
+
+def metrics_api(request):
+    if not metrics.ENABLED:
+        raise Http404
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4")
+
+def rooms_api(request):
+    try:
+        page = directory.rooms_page(
+            request.GET.get("order", "name"),
+            request.GET.get("prefix", ""),
+            request.GET.get("cursor"),
+            request.GET.get("limit", directory.PAGE_SIZE),
+        )
+    except ValueError as exc:
+        return JsonResponse({"detail": str(exc)}, status=400)
+    return JsonResponse(page)
 
 def index(request):
     if request.method == "POST":
@@ -28,14 +62,42 @@ def index(request):
         if name:
             room, _ = Room.objects.get_or_create(name=name)
             return HttpResponseRedirect(reverse("room", args=[room.pk]))
-    rooms = Room.objects.all().order_by("name")
-    return render(request, "chat/index.html", {"rooms": rooms})
+    order = request.GET.get("order", "name")
+    if order not in directory.ORDERINGS:
+        order = "name"
+    page = directory.rooms_page(order, request.GET.get("prefix", ""), request.GET.get("cursor"))
+    return render(request, "chat/index.html", {
+        "rooms": page["rooms"],
+        "order": order,
+        "prefix": page["prefix"],
+        "next_cursor": page["next_cursor"],
+    })
 
 @login_required
 def room(request, pk: int):
     room = get_object_or_404(Room, pk=pk)
-    messages = room.messages.select_related("user").order_by("created_at")
-    return render(request, "chat/room.html", {"room": room, "messages": messages})
+    messages = messages_before(room.pk, limit=PAGE_SIZE)
+    return render(request, "chat/room.html", {
+        "room": room,
+        "messages": messages,
+        "has_more": len(messages) == PAGE_SIZE,
+    })
+
+@login_required
+def room_search_api(request, pk: int):
+    room = get_object_or_404(Room, pk=pk)
+    query = request.GET.get("q", "")
+    try:
+        limit = max(1, min(int(request.GET.get("limit", SEARCH_PAGE_SIZE)), SEARCH_MAX_PAGE_SIZE))
+    except ValueError:
+        limit = SEARCH_PAGE_SIZE
+    results, next_cursor = search_backend().search(room.pk, query, request.GET.get("cursor"), limit)
+    return JsonResponse({
+        "room_id": room.pk,
+        "query": query,
+        "results": [{**MessageSerializer(msg).data, "score": score} for msg, score in results],
+        "next_cursor": next_cursor,
+    })
 
 def logout_view(request):
     logout(request)
@@ -0,0 +1,74 @@
+from typing import Optional
+
+import msgpack
+
+# Clients that list this in Sec-WebSocket-Protocol get msgpack binary
+# frames instead of JSON text. Message events are compacted further:
+#   {"r": request_id, "a": action, "pk": pk,
+#    "m": [id, text, user_id, created_at_epoch],
+#    "u": [user_id, username]}      <- only the first time a sender appears
+SUBPROTOCOL = "chat.msgpack"
+
+
+def negotiate(scope) -> Optional[str]:
+    return SUBPROTOCOL if SUBPROTOCOL in scope.get("subprotocols", ()) else None
+
+
+def pack(obj) -> bytes:
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def unpack(data: bytes):
+    return msgpack.unpackb(data, raw=False)
+
+
+def _map_header(size: int) -> bytes:
+    return bytes([0x80 | size]) if size < 16 else b"\xde" + size.to_bytes(2, "big")
+
+
+def message_fragment(instance, action: str) -> bytes:
+    """Pre-packed "a", "pk" and "m" map entries of a message event."""
+    return b"".join((
+        pack("a"), pack(action),
+        pack("pk"), pack(instance.pk),
+        pack("m"), pack([instance.pk, instance.text, instance.user_id, instance.created_at.timestamp()]),
+    ))
+
+
+def message_frame(request_id, fragment: bytes, user=None) -> bytes:
+    """Splice a per-subscription envelope around a pre-packed fragment."""
+    head = pack("r") + pack(request_id)
+    if user is None:
+        return _map_header(4) + head + fragment
+    return _map_header(5) + head + pack("u") + pack(user) + fragment
+
+
+class WireProtocolMixin:
+    """
+    Negotiates the msgpack subprotocol on accept() and, for connections
+    that chose it, sends and receives msgpack binary frames. JSON clients
+    are untouched.
+    """
+    binary = False
+
+    async def accept(self, subprotocol=None, headers=None):
+        subprotocol = subprotocol or negotiate(self.scope)
+        self.binary = subprotocol == SUBPROTOCOL
+        await super().accept(subprotocol=subprotocol, headers=headers)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        if bytes_data is not None and self.binary:
+            await self.receive_json(unpack(bytes_data), **kwargs)
+        else:
+            await super().receive(text_data=text_data, bytes_data=bytes_data, **kwargs)
+
+    async def send_json(self, content, close=False):
+        if self.binary:
+            await self.send(bytes_data=pack(content), close=close)
+        else:
+            await super().send_json(content, close=close)
+
+    async def encode_frame(self, content):
+        if self.binary:
+            return None, pack(content)
+        return await super().encode_frame(content)
@@ -56,6 +56,20 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        # Executor threads (CHAT_DB_READ_WORKERS) keep their connections.
+        "CONN_MAX_AGE": 60,
+        "OPTIONS": {
+            # WAL (set once by migration chat.0007, it persists in the file)
+            # lets the read pool run alongside the single writer.
+            "init_command": (
+                "PRAGMA synchronous=NORMAL;"
+                "PRAGMA temp_store=MEMORY;"
+                "PRAGMA mmap_size=134217728;"
+            ),
+            # Take the write lock up front instead of failing to upgrade a read lock.
+            "transaction_mode": "IMMEDIATE",
+            "timeout": 20,
+        },
     }
 }
 
@@ -71,9 +85,12 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        # Each process joins a group once and fans out to its own consumers.
+        "BACKEND": "chat.layers.NodeLocalRedisChannelLayer",
         "CONFIG": {
+            # Group keys are sharded across these hosts by consistent hash.
             "hosts": [("127.0.0.1", 6379)],
+            "local_fanout": True,
         },
     },
 }
@@ -92,7 +109,85 @@ CACHES = {
 
 PRESENCE_HEARTBEAT_SECONDS = 20      
 PRESENCE_TTL_SECONDS = 60  
+PRESENCE_BROADCAST_WINDOW_SECONDS = 1
+# Expired presence members are swept (and announced as offline / room_leave)
+# every N seconds in-process; 0 leaves it to `manage.py sweep_presence`.
+PRESENCE_SWEEP_INTERVAL_SECONDS = 60
+PRESENCE_SWEEP_BATCH_SIZE = 500
+# Presence goes to users sharing a room (cached this long) or watching explicitly.
+PRESENCE_AUDIENCE_TTL_SECONDS = 300
+PRESENCE_WATCH_MAX = 500
+# Usernames in the /api/online/ snapshots are cached this long (dropped on user save).
+PRESENCE_USERNAME_TTL_SECONDS = 3600
 AUTH_USER_MODEL = "chat.User"
 LOGIN_URL = "/login/"
 LOGIN_REDIRECT_URL = "/"
-LOGOUT_REDIRECT_URL = "/"
\ No newline at end of file
+LOGOUT_REDIRECT_URL = "/"
+
+# WebSocket handshakes resolve session -> user through Redis for this long;
+# logout and any save of the user drop the entry. 0 disables the cache.
+CHAT_AUTH_CACHE_TTL_SECONDS = 60
+
+# Read-only ORM calls from the consumers run on this many threads; writes
+# go through one writer thread. 0 keeps everything on channels' shared thread;
+# on SQLite that is faster overall (compare `loadtest --db-read-workers`).
+CHAT_DB_READ_WORKERS = 0
+
+# Persist create_message in bulk_create batches; acks wait for the batch commit.
+CHAT_MESSAGE_WRITE_BEHIND = False
+CHAT_MESSAGE_BATCH_SIZE = 100
+CHAT_MESSAGE_BATCH_SECONDS = 0.02
+
+# Size of the per-room recent-message buffer returned by join_room.
+CHAT_RECENT_MESSAGES = 50
+CHAT_RECENT_TTL_SECONDS = 86400
+# Rebuild reads retried when a message lands mid-read before serving uncached.
+CHAT_RECENT_REBUILD_ATTEMPTS = 3
+
+# Upper bound on the pks a single join_rooms call may subscribe to.
+CHAT_JOIN_ROOMS_MAX = 100
+
+# join_room replays at most this many missed messages before asking for a resync.
+CHAT_RESUME_MAX_MESSAGES = 200
+
+# Read positions (and the unread counters they reset) are written at most
+# once per membership per this many seconds.
+CHAT_READ_POSITION_FLUSH_SECONDS = 5
+
+# Per-user token buckets for ChatConsumer actions: action -> (per second, burst).
+CHAT_RATE_LIMITS = {
+    "create_message": (5, 20),
+    "search_messages": (1, 5),
+    "send_event": (2, 5),
+}
+# Outbound frames buffered per socket, and what to do when a client falls
+# behind: "drop", "coalesce" (replace backlog with a resync notice) or "disconnect".
+# Only servers whose send() waits on the socket fill the queue; under Daphne
+# it never does, so 0 (no queue, frames go straight out) is the default here.
+CHAT_SEND_QUEUE_SIZE = 0
+CHAT_SEND_OVERFLOW_POLICY = "coalesce"
+
+# Messages older than this move to compressed per-room archive segments
+# (`manage.py archive_messages`, or every N seconds in-process when set).
+CHAT_ARCHIVE_AFTER_DAYS = 90
+CHAT_ARCHIVE_SEGMENT_SIZE = 1000
+CHAT_ARCHIVE_INTERVAL_SECONDS = 0
+
+# Ephemeral room events (send_event) are coalesced into one frame per room per window.
+CHAT_EPHEMERAL_EVENTS = ("typing", "viewing")
+CHAT_EPHEMERAL_WINDOW_SECONDS = 0.5
+
+# Room directory (landing page and /api/rooms/): keyset pages cached in
+# Redis until a room or message is created.
+CHAT_DIRECTORY_PAGE_SIZE = 50
+CHAT_DIRECTORY_CACHE_TTL_SECONDS = 300
+
+# Full-text search; the backend defaults to FTS5 on SQLite and tsvector on PostgreSQL.
+CHAT_SEARCH_BACKEND = None
+CHAT_SEARCH_PAGE_SIZE = 20
+
+# In-process latency histograms served at /api/metrics/; False removes the timing wrappers.
+CHAT_METRICS_ENABLED = True
+
+# Dotted path to a dumps(obj) callable for WebSocket frames, e.g. "orjson.dumps".
+CHAT_JSON_DUMPS = None